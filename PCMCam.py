@@ -16,9 +16,6 @@ import time
 import ctypes
 import argparse
 import PIL.Image
-import PIL.TiffImagePlugin as PTIP
-#from PIL.TiffImagePlugin import AppendingTiffWriter
-import doriclib
 
 
 from PyQt5 import QtMultimedia
@@ -27,16 +24,22 @@ from PyQt5.QtCore import Qt
 
 import cv2
 
-from mplcanvas import MplCanvas
 from datetime import datetime
 
 import numpy as np
-from matplotlib.path import Path
-from matplotlib.lines import Line2D
-from matplotlib.patches import Patch, Rectangle
 
 from ctypes import wintypes
 import cameras
+from calib import DarkCalFile, GainCalFile, NoiseCalFile, CAL_FILENAME, GAIN_FILENAME, NOISE_FILENAME
+from calib import FAST_CAL_EXPOSURES, FAST_CAL_MIN_AVERAGES, FLAT_LEVEL_RANGE, DefectPixels, PixelStats
+from calib import cal_filename, correct_frame, fit_linear, gain_map, pixel_defects
+from captures import CaptureWriter, CaptureStore
+from denoise import FrameAverager, parse_denoise
+from display import DisplayLut, DisplayScheduler
+from frames import FramePool
+from histogram import AutoContrast, FrameHistogram
+from recorder import StackRecorder
+from roitrace import RoiTraces, TracePlot
 from screens import CapScreen, LiveScreen, TimeLapseScreen
 
 
@@ -44,23 +47,20 @@ from screens import CapScreen, LiveScreen, TimeLapseScreen
 Global parameters:
 """
 
-#TIFF_COMPRESSION = 'tiff_lzw'   # IF you compress, you lose (non-core) tags.
-TIFF_COMPRESSION = 'raw'
-
-
 # Video format.  Must be a FourCC codec supported by OpenCV (FFMPEG)
 #VIDEO_FORMAT = 'FFV1'   # lossless
 VIDEO_FORMAT = 'DIVX'  # lossy
 
-GAIN_TRACE_COLOR = 'r' # Matplotlib color
-HIST_TRACE_COLOR = 'b'
+GAIN_TRACE_COLOR = Qt.red
+HIST_TRACE_COLOR = Qt.blue
 HIST_NBINS = 64
+HIST_X_SHRINK = 0.8     # fraction of the histogram width used by the plot, to match the scrollbars
+HIST_Y_TOP = 1.05       # headroom above the tallest bar
 
 FPS_AVERAGES = 5
 
-FRAME_WIDTH = cameras.FRAME_WIDTH
-FRAME_HEIGHT = cameras.FRAME_HEIGHT
-FRAME_SHAPE = (FRAME_HEIGHT, FRAME_WIDTH)
+DENOISE_CHOICES = (('off', 1), ('boxcar', 2), ('boxcar', 4), ('boxcar', 8), ('boxcar', 16),
+                   ('ema', 4), ('ema', 8), ('ema', 16))
 
 __AUTHOR__ = 'Palmer'
 __PROGRAM_NAME__ = 'PCMCam'
@@ -89,10 +89,18 @@ class FlatFieldCal(object):
     """
     Class for managing flat-field calibration.
 
-    Currently calibration is only dark-field.  This seems to be the most important.  In memory, this is stored in
-    array ``black``.  In addition, this class manages file-based copies, arrays stored in numpy format.  if a directory
-    name is passed to init, or when the load method is called, the full ``black`` array is loaded from that path.
-    During a new calibration sequence, the array for that exposure is writen to the file when it's been acquired.
+    Frames are corrected as ``(frame - black) * gain``.  The dark frames are stored in ``black``, an (exposures,
+    height, width) array, and the gain maps (reciprocal of the normalized flat field) in ``gain``.  The dark
+    calibration also measures the per-pixel dark noise, kept in ``noise``, from which the hot/noisy/dead pixel map
+    of an exposure is derived (``defect_map``).  Those pixels are replaced by the median of their neighbours.  When
+    loaded, these are memory maps of the calibration files (calib.DarkCalFile, calib.GainCalFile,
+    calib.NoiseCalFile) in the FFC directory, so only the exposures actually used are read from disk.  During a
+    calibration sequence, running frame statistics are kept in ``stats`` and the result for each exposure is written
+    to the file when it's been acquired.  Exposures without a gain map are only dark corrected.
+
+    The fast dark calibration measures only a few exposures (FAST_CAL_EXPOSURES), fits dark level and variance per
+    pixel as nframes x offset + rate x exposure (nframes being the camera frames summed), and synthesizes all the
+    exposures from the fit.
     """
     def __init__(self, parent):
         """
@@ -102,54 +110,224 @@ class FlatFieldCal(object):
         parent : QObject
             parent window (I think)
         """
-        self.acq_state = 0 # 0=normal, 1=acquiring black correction
+        self.acq_state = 0 # 0=normal, 1=acquiring black correction, 2=acquiring gain (flat field)
         self.frame = 0 # frame counter
         self.exp_ind = 0  # exposure index counter (for cycling)
         self.hold_exp_indices = [0, 0] # copy of currently set exposure index
+        self.fast_cal = False # fast (fitted) dark calibration in progress
         self.parent = parent
         self.camera = parent.camera
         self.config = parent.config
         self.progdialog = None          # to be set
-
+        self.shape = self.camera.frame_shape            # frames as read out (binning, AOI)
+        self.pool = FramePool(self.shape, np.int16)     # corrected frames
+        self.cal_file = None
+        self.gain_file = None
+        self.noise_file = None
+        self.stats = PixelStats(self.shape)   # frame mean and variance during calibration
+        self.new_black = np.empty(self.shape, np.int16)
+        self.scratch = np.empty(self.shape, np.float32)   # for gain correction
+        self.defects = {}               # exposure index -> defect map, computed when needed
+        self.defect_pixels = {}         # exposure index -> DefectPixels, computed when needed
+
+        n_exp = len(self.camera.exposure_settings)
         if self.config.cal_auto_load:
             self.load()
         else:
-            self.black = []
-            for e in self.camera.exposure_settings:
-                self.black.append(np.zeros(FRAME_SHAPE, np.int16))
+            self.black = np.zeros((n_exp,) + self.shape, np.int16)
+            self.gain = np.ones((n_exp,) + self.shape, np.float32)
+            self.gain_ok = [False] * n_exp
+            self.noise = np.zeros((n_exp,) + self.shape, np.float32)
+            self.noise_ok = [False] * n_exp
         self.prior_black = None
 
+    def _open_cal_file(self, cls, fn):
+        """
+        Open (map) a calibration file in the FFC directory.  File names are qualified by the camera's readout mode.
+
+        Returns
+        -------
+        cal : DarkCalFile (or subclass)
+            None if there's no usable file.
+        """
+        p = os.path.join(self.config.ffc_dir, cal_filename(fn, self.camera.readout_tag))
+        if not os.path.isfile(p):
+            return None
+        try:
+            cal = cls(p, 'r+' if self.config.cal_auto_save else 'c')
+        except (OSError, ValueError) as e:
+            print('Ignoring cal %s: %s' % (p, e))
+            return None
+        if not cal.matches(self.camera.exposure_settings, self.shape):
+            print('Ignoring cal %s: exposures or frame size differ' % p)
+            return None
+
+        print('Loading cal: ', p)
+        if cal.serial != self.camera.dev_list[0][2]:
+            print('Warning: cal was made with camera S/N %s' % cal.serial)
+        return cal
+
+    def _create_cal_file(self, cls, fn, data):
+        """
+        Create a calibration file in the FFC directory (replacing any unusable file), initialized from data.
+        """
+        if not os.path.isdir(self.config.ffc_dir):
+            os.makedirs(self.config.ffc_dir)
+        p = os.path.join(self.config.ffc_dir, cal_filename(fn, self.camera.readout_tag))
+        print('writing: ', p)
+        cal = cls.create(p, self.camera.exposure_settings, self.shape, self.camera.dev_list[0][2])
+        cal.black[...] = data
+        cal.black.flush()
+        return cal
+
     def load(self):
         """
-        Load calibration files into memory.
+        Map the calibration files.  If there is no dark calibration (or it doesn't fit this camera's exposures), start
+        from zeros, importing any per-exposure BLKnnnnn.npy files written by older versions (full-frame readout only).
 
         Returns
         -------
 
         """
-        self.black = []
+        n_exp = len(self.camera.exposure_settings)
+
+        self.gain_file = self._open_cal_file(GainCalFile, GAIN_FILENAME)
+        if self.gain_file is not None:
+            self.gain = self.gain_file.gain
+            self.gain_ok = [self.gain_file.calibrated(i) for i in range(n_exp)]
+        else:
+            self.gain = np.ones((n_exp,) + self.shape, np.float32)
+            self.gain_ok = [False] * n_exp
+
+        self.noise_file = self._open_cal_file(NoiseCalFile, NOISE_FILENAME)
+        if self.noise_file is not None:
+            self.noise = self.noise_file.noise
+            self.noise_ok = [self.noise_file.calibrated(i) for i in range(n_exp)]
+        else:
+            self.noise = np.zeros((n_exp,) + self.shape, np.float32)
+            self.noise_ok = [False] * n_exp
+
+        self.cal_file = self._open_cal_file(DarkCalFile, CAL_FILENAME)
+        if self.cal_file is not None:
+            self.black = self.cal_file.black
+            return
 
-        for e in self.camera.exposure_settings:
+        self.black = np.zeros((n_exp,) + self.shape, np.int16)
+        imported = False
+        for i, e in enumerate(self.camera.exposure_settings):
             p = os.path.join(self.config.ffc_dir, 'BLK%5.5d.npy' % e)
-            if os.path.isfile(p):
-                print('Loading cal: ', p)
-                self.black.append(np.load(p).astype(np.int16))  # older versions might have saved uint
-            else:
-                self.black.append(np.zeros(FRAME_SHAPE, np.int16))
+            if os.path.isfile(p) and not self.camera.readout_tag:
+                print('Importing cal: ', p)
+                self.black[i] = np.load(p)  # older versions might have saved uint
+                imported = True
 
-    def start_black_cal(self):
+        if imported and self.config.cal_auto_save:
+            self._writable_cal_file()
+
+    def _writable_cal_file(self):
+        """
+        Return the dark calibration file, open for writing.  If it isn't, create it from the dark frames currently in
+        memory and switch ``black`` over to it.
+        """
+        if self.cal_file is None or not self.cal_file.writable:
+            self.cal_file = self._create_cal_file(DarkCalFile, CAL_FILENAME, self.black)
+            self.black = self.cal_file.black
+
+        return self.cal_file
+
+    def _writable_gain_file(self):
+        """
+        As _writable_cal_file, for the gain calibration file.
+        """
+        if self.gain_file is None or not self.gain_file.writable:
+            self.gain_file = self._create_cal_file(GainCalFile, GAIN_FILENAME, self.gain)
+            self.gain = self.gain_file.gain
+            for i, ok in enumerate(self.gain_ok):
+                if ok:
+                    self.gain_file.store(i, self.gain[i])
+
+        return self.gain_file
+
+    def _writable_noise_file(self):
+        """
+        As _writable_cal_file, for the dark noise file.
+        """
+        if self.noise_file is None or not self.noise_file.writable:
+            self.noise_file = self._create_cal_file(NoiseCalFile, NOISE_FILENAME, self.noise)
+            self.noise = self.noise_file.noise
+            for i, ok in enumerate(self.noise_ok):
+                if ok:
+                    self.noise_file.store(i, self.noise[i])
+
+        return self.noise_file
+
+    def defect_map(self, ndx):
+        """
+        Defect pixel map (calib.pixel_defects) for exposure index ndx.
+
+        Returns
+        -------
+        defects : ndarray
+            uint8 DEFECT_xxx bits, or None if there's no noise map for this exposure (dark calibration not done, or
+            imported from an older version).
+        """
+        if not self.noise_ok[ndx]:
+            return None
+        if ndx not in self.defects:
+            self.defects[ndx] = pixel_defects(self.black[ndx], self.noise[ndx])
+        return self.defects[ndx]
+
+    def defect_fixer(self, ndx):
+        """
+        DefectPixels replacing the defect pixels of exposure index ndx, or None if there's no defect map.
+        """
+        if ndx not in self.defect_pixels:
+            defects = self.defect_map(ndx)
+            self.defect_pixels[ndx] = None if defects is None else DefectPixels(defects)
+        return self.defect_pixels[ndx]
+
+    def start_black_cal(self, fast=False):
+        """
+        Start a dark calibration sequence.
+
+        Parameters
+        ----------
+        fast : bool
+            measure only FAST_CAL_EXPOSURES and synthesize the rest from a per-pixel linear fit.
+        """
+        exposures = self.camera.exposure_settings
+        if fast:
+            indices = sorted(set(int(np.argmin(np.abs(np.subtract(exposures, e)))) for e in FAST_CAL_EXPOSURES))
+        else:
+            indices = list(range(len(exposures)))
+        self.fast_cal = fast
+        self.fast_measured = []
+        self.camera.set_cal_state(True) # notify the camera api in case it needs to know we are calibrating
+        self._start_cal(1, "Fast Black Field Calibration" if fast else "Black Field Calibration", indices)
+
+    def start_gain_cal(self):
+        """
+        Start a flat-field calibration sequence.  The field must be uniformly illuminated, and the dark calibration
+        done, since flat frames are dark corrected with it.
+        """
+        self.fast_cal = False
+        self._start_cal(2, "Flat Field Calibration", list(range(len(self.camera.exposure_settings))))
+
+    def _start_cal(self, acq_state, title, indices):
         self.hold_exp_indices = [self.camera.current_exposure_index, self.camera.current_ifi_index] # for later restoration
         self.frame_ind = 0 # frame counter
-        self.exp_ind = 0 # exposure index counter (for cycling)
+        self.cal_indices = indices # exposure indices to calibrate
+        self.cal_pos = 0 # position in cal_indices
+        self.exp_ind = indices[0] # exposure index
         self.prior_black = np.copy(self.black[0])
-        self.black[0].fill(0) # because black integrates frames during cal sequence.
+        self.stats.reset()
         self.discard_next = True
-        self.camera.set_cal_state(True) # notify the camera api in case it needs to know we are calibrating
         self.camera.set_exposure(self.exp_ind, 0)
-        self.acq_state = 1 # internal indicator that we are calibrating
+        self.acq_state = acq_state # internal indicator that we are calibrating
+        self.gain_done = []
 
         self.progdialog = QtWidgets.QProgressDialog(
-            "Black Field Calibration", "Cancel", 0, len(self.camera.exposure_settings), self.parent)
+            title, "Cancel", 0, len(self.cal_indices), self.parent)
         self.progdialog.setWindowTitle("Calibration")
         self.progdialog.canceled.connect(self.cancel_cal)
         self.progdialog.setModal(True)
@@ -169,61 +347,187 @@ class FlatFieldCal(object):
         self.progdialog.close()
 
     def update_progress(self):
-        self.progdialog.setValue(self.exp_ind)
-        if self.exp_ind < len(self.camera.exposure_settings):
+        self.progdialog.setValue(self.cal_pos)
+        if self.cal_pos < len(self.cal_indices):
             self.progdialog.setLabelText('Calibrating %d ms exposure...' % self.camera.exposure_settings[self.exp_ind])
 
 
     def next_cal(self):
-        self.black[self.exp_ind] //= self.camera.black_cal_averages[self.exp_ind]
-
-
-        std = np.std(self.prior_black - self.black[self.exp_ind])
-
-        print('Exposure: %d ms, black mean %.1f, RMS error from previous: %.1f' %
-              (self.camera.exposure_settings[self.exp_ind], self.black[self.exp_ind].mean(), std))
-
-        if self.config.cal_auto_save:
-            if not os.path.isdir(self.config.ffc_dir):
-                os.makedirs(self.config.ffc_dir)
-            p = os.path.join(self.config.ffc_dir, 'BLK%5.5d.npy' % self.camera.exposure_settings[self.exp_ind])
-            print('writing: ', p)
-            np.save(p, self.black[self.exp_ind])
+        if self.acq_state == 1:
+            self._next_black()
+        else:
+            self._next_gain()
 
         #return self.stop_cal()
         
-        self.exp_ind += 1
-        if self.exp_ind == len(self.camera.exposure_settings):
+        self.cal_pos += 1
+        if self.cal_pos == len(self.cal_indices):
+            if self.acq_state == 2:
+                self._fill_gain()
+            elif self.fast_cal:
+                self._fit_black()
             self.stop_cal()
         else:
+            self.exp_ind = self.cal_indices[self.cal_pos]
             self.frame_ind = 0
             self.prior_black = np.copy(self.black[self.exp_ind])
-            self.black[self.exp_ind].fill(0) # because black integrates frames during cal sequence.
+            self.stats.reset()
             self.camera.set_exposure(self.exp_ind, 0)
 
         self.update_progress()
 
+    def _next_black(self):
+        if self.fast_cal:
+            variance = self.stats.std(np.empty(self.shape, np.float32)) ** 2
+            self.fast_measured.append((self.exp_ind, self.stats.mean.astype(np.float32), variance))
+            print('Exposure: %d ms, black mean %.1f, measured for fit' %
+                  (self.camera.exposure_settings[self.exp_ind], self.stats.mean.mean()))
+            return
+
+        black = self.stats.rounded_mean(self.new_black)
+        noise = self.stats.std(self.scratch)
+        self._store_black(self.exp_ind, black, noise)
+
+        std = np.std(self.prior_black - black)
+
+        print('Exposure: %d ms, black mean %.1f, noise %.2f, RMS error from previous: %.1f, defect pixels %d' %
+              (self.camera.exposure_settings[self.exp_ind], black.mean(), np.median(noise), std,
+               np.count_nonzero(self.defect_map(self.exp_ind))))
+
+    def _store_black(self, ndx, black, noise):
+        if self.config.cal_auto_save:
+            self._writable_cal_file().store(ndx, black)
+            self._writable_noise_file().store(ndx, noise)
+        else:
+            self.black[ndx] = black
+            self.noise[ndx] = noise
+        self.noise_ok[ndx] = True
+        self.defects.pop(ndx, None)
+        self.defect_pixels.pop(ndx, None)
+
+    def _fit_black(self):
+        """
+        End of a fast dark calibration: fit the measured exposures, synthesize dark and noise frames for every
+        exposure and report how well the fit matches the measured frames (and the previous calibration).
+
+        Exposures summing several camera frames (camera.exposure_frames) carry the dark offset and read variance
+        once per frame, so both are fitted as nframes x offset + rate x exposure.
+        """
+        exposures = self.camera.exposure_settings
+        nframes = self.camera.exposure_frames
+        t = [exposures[i] for i, mean, var in self.fast_measured]
+        n = [nframes[i] for i, mean, var in self.fast_measured]
+        try:
+            offset, rate = fit_linear(t, [mean for i, mean, var in self.fast_measured], n)
+            var_offset, var_rate = fit_linear(t, [var for i, mean, var in self.fast_measured], n)
+        except ValueError as e:
+            print('Fast cal FAILED, calibration unchanged: %s' % e)
+            return
+
+        print('Fast cal fit: dark offset %.1f, dark rate %.3f /s, residuals:' %
+              (np.median(offset), 1000. * np.median(rate)))
+        for i, mean, var in self.fast_measured:
+            resid = mean - (nframes[i] * offset + rate * exposures[i])
+            print('  Exposure: %d ms, fit residual RMS %.2f, max %.1f, measured noise %.2f' %
+                  (exposures[i], np.sqrt(np.mean(resid ** 2)), np.abs(resid).max(), np.sqrt(np.median(var))))
+
+        for i, e in enumerate(exposures):
+            prior = np.copy(self.black[i])
+            black = np.rint(nframes[i] * offset + rate * e, out=self.new_black, casting='unsafe')
+            noise = np.sqrt(np.maximum(nframes[i] * var_offset + var_rate * e, 0.), out=self.scratch)
+            self._store_black(i, black, noise)
+            print('  Exposure: %d ms, black mean %.1f, RMS difference from previous: %.1f' %
+                  (e, black.mean(), np.std(prior - black)))
+
+    def _next_gain(self):
+        """
+        Make the gain map for this exposure, unless the flat is too dim or close to saturation to be useful.
+        """
+        flat_mean = self.stats.mean.mean()
+        lo, hi = FLAT_LEVEL_RANGE
+        if not lo * self.camera.pixel_maxval <= flat_mean <= hi * self.camera.pixel_maxval:
+            print('Exposure: %d ms, flat mean %.1f, not used' %
+                  (self.camera.exposure_settings[self.exp_ind], flat_mean))
+            return
+
+        level = gain_map(self.stats.mean, self.black[self.exp_ind], self.scratch)
+        print('Exposure: %d ms, flat mean %.1f, gain range %.2f - %.2f' %
+              (self.camera.exposure_settings[self.exp_ind], level, self.scratch.min(), self.scratch.max()))
+        self._store_gain(self.exp_ind, self.scratch)
+        self.gain_done.append(self.exp_ind)
+
+    def _store_gain(self, ndx, gain):
+        if self.config.cal_auto_save:
+            self._writable_gain_file().store(ndx, gain)
+        else:
+            self.gain[ndx] = gain
+        self.gain_ok[ndx] = True
+
+    def _fill_gain(self):
+        """
+        At the end of a flat-field sequence, give the exposures that couldn't be calibrated (dim or saturated flat)
+        the gain map of the nearest one that was.
+        """
+        if len(self.gain_done) == 0:
+            print('No usable flat field exposures, gain calibration unchanged')
+            return
+
+        exposures = self.camera.exposure_settings
+        for i in range(len(exposures)):
+            if i not in self.gain_done:
+                nearest = min(self.gain_done, key=lambda j: abs(np.log(exposures[j] / exposures[i])))
+                self._store_gain(i, self.gain[nearest])
+
     def stop_cal(self):
         self.camera.set_exposure(self.hold_exp_indices[0], self.hold_exp_indices[1])
         self.camera.set_cal_state(False)
         self.acq_state = 0
-        self.progdialog.setValue(len(self.camera.exposure_settings))
+        self.progdialog.setValue(len(self.cal_indices))
 
     def accumulate_frame(self, frame):
-        self.black[self.exp_ind] += frame
+        self.stats.add(frame)
         self.frame_ind += 1
-        if self.frame_ind == self.camera.black_cal_averages[self.exp_ind]:
+        averages = self.camera.black_cal_averages[self.exp_ind]
+        if self.fast_cal:
+            averages = max(averages, FAST_CAL_MIN_AVERAGES)
+        if self.frame_ind == averages:
             self.next_cal()
 
     def black_correct(self, frame):
+        """
+        Correct a frame into a pooled output frame, or feed it to the calibration in progress.  Exposures with a
+        gain map are flat-field corrected in the same pass if the GainCorrect option is on, and defect pixels are
+        replaced if the DefectCorrect option is on.
+
+        Parameters
+        ----------
+        frame : Frame
+
+        Returns
+        -------
+        cframe : Frame
+            new reference, owned by the caller.  During calibration, or if the caller holds the only reference to
+            the input frame (it's then corrected in place), this is the input frame itself.
+        """
         if self.calibrating:
             if self.discard_next:
                 self.discard_next = False
-                return frame
-            self.accumulate_frame(frame)
-            return frame
+                return frame.acquire()
+            self.accumulate_frame(frame.data)
+            return frame.acquire()
         else:
-            return np.maximum(0, frame - self.black[self.camera.current_exposure_index])
+            if frame.refs == 1 and frame.data.dtype == self.pool.dtype:
+                cframe = frame.acquire()    # nobody else has it, correct in place
+            else:
+                cframe = self.pool.get(like=frame)
+            ndx = self.camera.current_exposure_index
+            gain = self.gain[ndx] if self.config.gain_correct and self.gain_ok[ndx] else None
+            correct_frame(frame.data, self.black[ndx], cframe.data, gain, self.scratch, 2**frame.pixel_bits - 1)
+            if self.config.defect_correct:
+                fixer = self.defect_fixer(ndx)
+                if fixer is not None:
+                    fixer.apply(cframe.data)
+            return cframe
 
     @property
     def calibrating(self):
@@ -237,10 +541,12 @@ class DispParam(object):
     """
     def __init__(self):
         self.iwindow = [[0., 100.]]  # intensity range as percent
-        self.latest_frame = None           # Most recent frame
+        self.latest = None           # Most recent (corrected) Frame, a reference is held
         self.frame_timestamp = [datetime.now()]
+        self.pixel_bits = [0]        # pixel depth of each capture (index 0 unused)
         self.n_caps = 0
         self.cur_cap = None          # current capture that's displayed
+        self.cap_store = None        # CaptureStore of captured frames, set up by the viewer
         self.caps_saved = True
         self.cap_live_swap = False   # true when live and capture screens are swapped
         self.fps_history = []
@@ -254,6 +560,9 @@ class DispParam(object):
 
         self.iwindow = self.iwindow[:1]
         self.frame_timestamp = self.frame_timestamp[:1]
+        self.pixel_bits = self.pixel_bits[:1]
+        if self.cap_store is not None:
+            self.cap_store.clear()
         self.n_caps = 0
         self.cur_cap = None
         self.caps_saved = True
@@ -278,46 +587,73 @@ class DispParam(object):
         self.fps_estimate = np.mean(self.fps_history)
         return self.fps_estimate
 
+    def set_latest(self, frame):
+        """
+        Replace the latest frame, taking over the caller's reference and dropping the one held on the previous frame.
+        """
+        if self.latest is not None:
+            self.latest.release()
+        self.latest = frame
 
-class HistCanvas(MplCanvas):
-    """Histogram Figure Canvas and QWidget"""
-
-    """
-    def __init__(self,  *args):
-        super().__init__(*args)
+    @property
+    def latest_frame(self):
+        """
+        Pixel data of the most recent frame.  Only valid until the next frame arrives.
+        """
+        return None if self.latest is None else self.latest.data
 
-        position = [0., 0., 1., 1.]
 
-        self.axes.hold(True)        
-        self.axes.set_position(position)
-        self.axes.yaxis.set_visible(False)
-        self.axes.xaxis.set_visible(False)
-        self.axes.set_frame_on(False)
+class HistCanvas(QtWidgets.QWidget):
     """
-    def compute_initial_figure(self):
-        
-        gcx_shrink = 0.8
-        gcx_offset = (1. - gcx_shrink)/2.
+    Histogram bars and gain curve, drawn directly with QPainter.
 
-        position = [gcx_offset, 0., gcx_shrink, 1.]
-        self.axes.set_position(position)
-        self.axes.yaxis.set_visible(False)
-        self.axes.xaxis.set_visible(False)
-        self.axes.set_frame_on(True)
+    Both are in normalized (0, 1) coordinates.  The plot area is shrunk horizontally (HIST_X_SHRINK) so the gain curve
+    lines up with the mini/maxi scrollbars above and below it.
+    """
 
-        l = Line2D([], [], color=GAIN_TRACE_COLOR)
-        self.gain_trace = self.axes.add_line(l)
+    def __init__(self, parent=None, width=320, height=156):
+        super().__init__(parent)
+        self.setFixedSize(width, height)
+        self.setAttribute(Qt.WA_OpaquePaintEvent)   # paintEvent fills the whole widget
+        self.hcurve_y = np.zeros(HIST_NBINS)
+        self.gcurve_x = []
+        self.gcurve_y = []
 
+    def update_plot(self, hcurve_y, gcurve_x, gcurve_y):
         """
-        l = Line2D([], [], color=HIST_TRACE_COLOR)
-        self.hist_trace = self.axes.add_line(l)
+        Set the bar heights and gain curve, and schedule a repaint.
         """
+        self.hcurve_y = hcurve_y
+        self.gcurve_x = gcurve_x
+        self.gcurve_y = gcurve_y
+        self.update()
+
+    def paintEvent(self, event):
+        w = self.width()
+        h = self.height() - 1
+        x0 = w * (1. - HIST_X_SHRINK) / 2.
+        pw = w * HIST_X_SHRINK
+        ph = h / HIST_Y_TOP
+
+        qp = QtGui.QPainter(self)
+        qp.fillRect(self.rect(), Qt.white)
 
-        hcurve_y = np.arange(HIST_NBINS) / HIST_NBINS
-        hcurve_x = np.arange(HIST_NBINS) / HIST_NBINS
-        self.hist_bars = self.axes.bar(hcurve_x, hcurve_y, color = HIST_TRACE_COLOR, width=1./HIST_NBINS)
+        n = len(self.hcurve_y)
+        bar_x = x0 + pw * np.arange(n) / n
+        bar_h = ph * np.asarray(self.hcurve_y)
+        qp.setPen(Qt.NoPen)
+        qp.setBrush(HIST_TRACE_COLOR)
+        qp.drawRects([QtCore.QRectF(x, h - bh, pw / n, bh) for x, bh in zip(bar_x, bar_h)])
+
+        qp.setPen(QtGui.QPen(GAIN_TRACE_COLOR, 1))
+        qp.drawPolyline(QtGui.QPolygonF([QtCore.QPointF(x0 + pw * x, h - ph * y)
+                                         for x, y in zip(self.gcurve_x, self.gcurve_y)]))
+
+        qp.setPen(Qt.black)
+        qp.setBrush(Qt.NoBrush)
+        qp.drawRect(QtCore.QRectF(x0, 0, pw, h))
+        qp.end()
 
-        #self.gain_graph = self.axes.plot([0, 1.], [0, 1.], color = HIST_TRACE_COLOR)
 
 class TimeStamp():
     def __init__(self, label_widget):
@@ -334,6 +670,9 @@ class TimeStamp():
     def time_string(self):
         return self.ts.strftime('%H%M%S')
 
+def _denoise_label(mode, n):
+    return 'Off' if mode == 'off' else '%s %d' % ('Avg' if mode == 'boxcar' else 'EMA', n)
+
 def now_with_f_secs():
     """
     Helper function
@@ -362,24 +701,34 @@ class Viewer(QtWidgets.QMainWindow):
         self.config = config
 
         self.dpar = DispParam()
-
-        self.setup_graphics_view()
-        self.setFocusPolicy(Qt.StrongFocus)
-        self.setWindowTitle(BANNER)
-        self.timestamp = TimeStamp(self.epoch_label)
-
-
-        """
-        see http://stackoverflow.com/questions/1551605/how-to-set-applications-taskbar-icon-in-windows-7/1552105#1552105
+        self.live_lut = DisplayLut()    # separate tables so live and capture windows don't thrash one cache
+        self.cap_lut = DisplayLut()
+        self.histogram = FrameHistogram()   # of the latest frame, also used for contrast settings
+        self.roi_histogram = FrameHistogram()
+        self.auto_contrast = AutoContrast(self.config.auto_contrast_clip)
+        self.video_lut = DisplayLut()
+        self.display_scheduler = DisplayScheduler(self.render_live, self.config.display_max_fps, self)
+        self.averager = FrameAverager(*self.config.denoise)    # live denoise
+        self.roi_traces = RoiTraces(self.config.roi_trace_length)
+        self.tracing = False
+        self.cap_writer = CaptureWriter()
+        self.cap_writer.done.connect(self.__cap_written_callback)
+        self.dpar.cap_store = CaptureStore(self.config.cap_cache_mb)
+
+        """
+        The camera is opened before the GUI is built, as its readout mode sets the frame size.
         """
-        ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(PROG_APP_ID)
-        self.setWindowIcon(QtGui.QIcon(PROG_ICON_FILE))
-
         if int(cam_index) == 0:
             # lookup and build menu listof UC480 camera(s)
 
             Pref = 'UC480: '
-            self.uc480_camera = cameras.UC480_Camera()
+            try:
+                self.uc480_camera = cameras.UC480_Camera(acq_thread=self.config.acq_thread,
+                                                         seq_buffers=self.config.seq_buffers,
+                                                         binning=self.config.sensor_binning,
+                                                         aoi=self.config.sensor_aoi)
+            except ValueError as e:
+                raise SystemExit('%s%s' % (Pref, e))
 
             if self.uc480_camera.dev_list is None:
                 raise SystemExit('%s: --no library--' % Pref)
@@ -402,7 +751,7 @@ class Viewer(QtWidgets.QMainWindow):
         elif int(cam_index) == 2:
             # lookup and build menu listof Pseudo camera(s)
             Pref = 'Pseudo: '
-            self.pseudo_camera = cameras.Pseudo_Camera()
+            self.pseudo_camera = cameras.Pseudo_Camera(fps=self.config.pseudo_fps, seed=self.config.pseudo_seed)
     
             sttstr = Pref + '%d/%s/%s' % self.pseudo_camera.dev_list[0]
             self.camera = self.pseudo_camera
@@ -410,6 +759,19 @@ class Viewer(QtWidgets.QMainWindow):
         else:
             raise SystemExit('Unknown Camera type: <%s>' % cam_index)
 
+        self.setup_graphics_view()
+        self.setFocusPolicy(Qt.StrongFocus)
+        self.setWindowTitle(BANNER)
+        self.timestamp = TimeStamp(self.epoch_label)
+
+
+        """
+        see http://stackoverflow.com/questions/1551605/how-to-set-applications-taskbar-icon-in-windows-7/1552105#1552105
+        """
+        ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(PROG_APP_ID)
+        self.setWindowIcon(QtGui.QIcon(PROG_ICON_FILE))
+
+
         self.cam_label.setText(sttstr)
         self.camera.connect(self.winId())
         if self.config.black_correct:
@@ -691,14 +1053,14 @@ class Viewer(QtWidgets.QMainWindow):
 
         return fn
 
-    def _get_cap_filename(self):
+    def _get_cap_filename(self, ndx=None):
         """
-        return the path to the current capture filename.  Also, make the directory, in case it
-        doesn't yet exist.
+        return the path to the current capture filename (or that of capture ndx).  Also, make the directory, in case
+        it doesn't yet exist.
         """
 
         fnd = self._get_session_dir()
-        fn = os.path.join(fnd,  'F%4.4d.tif' % self.dpar.cur_cap)
+        fn = os.path.join(fnd,  'F%4.4d.tif' % (self.dpar.cur_cap if ndx is None else ndx))
 
         return fn
 
@@ -762,11 +1124,12 @@ class Viewer(QtWidgets.QMainWindow):
         Perform a capture operation.
 
         The process is as follows:
-            * make a copy of the most recent live frame (dpar.latest_frame).
+            * take a reference to the most recent live frame (dpar.latest).
             * append this, the window settings, and a timestamp to the respective lists in self.dpar
             * play a sound (if configured to do so and unless recording is active
-            * write this capture to a file (autosave) if configured to do so but now always works
-            * update the capture palette (titles, colors...)
+            * queue this capture for writing to a file.  The write completes in the background and is logged
+              by __cap_written_callback
+            * update the capture palette (titles, colors...) from the in-memory frame
 
         Returns
         -------
@@ -781,6 +1144,9 @@ class Viewer(QtWidgets.QMainWindow):
         self.dpar.cur_cap = self.dpar.n_caps
         self.dpar.iwindow.append(list(self.dpar.iwindow[0]))  # deep copy
         self.dpar.frame_timestamp.append(tstamp)
+        self.dpar.pixel_bits.append(self.dpar.latest.pixel_bits)
+        cfn = self._get_cap_filename()
+        self.dpar.cap_store.add(self.dpar.n_caps, self.dpar.latest.acquire(), cfn)
 
         self.cap_scrollbar.setRange(1, self.dpar.n_caps)
         self.cap_scrollbar.setValue(self.dpar.n_caps)
@@ -797,46 +1163,58 @@ class Viewer(QtWidgets.QMainWindow):
         #im.save("test2.tiff", "TIFF")
         # https://gist.github.com/ax3l/5781ce80b19d7df3f549#pillow
 
-        """
-        Note that despite lack of documenation, this does save as 16-bit gray-scale image.  Open in Photoshop to
-        confirm. Irfan converts to 8 bpp upon opening ans scales pixels
-        """
-        cfn = self._get_cap_filename()
-        cap_image = np.copy(self.dpar.latest_frame).astype(np.uint16)
-        im = PIL.Image.fromarray((cap_image << (16 - self.camera.pixel_bits)).astype(np.uint16))
-        im.save(cfn, 'TIFF')
+        self.cap_writer.write(cfn, self.dpar.latest.acquire(), self.dpar.latest.pixel_bits)
 
         """        
         cap_image = np.copy(self.dpar.latest_frame).astype(np.uint16)
         cv2.imwrite(cfn, (cap_image << (16 - self.camera.pixel_bits)).astype(np.uint16))
         """
 
-        et = np.int(np.round(self.camera.actual_exposure_time_ms))
-        fn = os.path.basename(cfn)
-
-        self.write_to_log('%d\t%s' % (et, fn))
-
         self.swap_button.setEnabled(True)
         self.update_cap_image()
 
 
-    def _get_pixmap(self, frame, iwin):
-        
-        sframe = frame.astype(np.float)/self.camera.pixel_maxval
+    def _get_pixmap(self, frame, iwin, lut, pixel_bits):
+        """
+        Window a frame to 8 bits and wrap it in a pixmap.
 
-        smin, smax = iwin[0]/100., iwin[1]/100.
-        
-        sframe -= smin
-        sframe *= 255. / (smax - smin)
-        
-        sframe = np.clip(sframe, 0, 255.)
-        gray = np.require(sframe, np.uint8, 'C')
+        Parameters
+        ----------
+        frame : ndarray
+            frame, or strided view of one
+        iwin : [float, float]
+            intensity window in percent of the frame's full scale
+        lut : DisplayLut
+            look-up table (and buffer) to use.  The returned gray array belongs to it.
+        pixel_bits : int
+            pixel depth of the frame, which sets the full scale
+
+        Returns
+        -------
+        pix : QPixmap
+        gray : ndarray (uint8)
+        """
+        gray = lut.apply(frame, iwin, 2**pixel_bits)
 
         h, w = gray.shape
-    
-        im = QtGui.QImage(gray.data, w, h, QtGui.QImage.Format_Indexed8)
+
+        """
+        Rows of a strided thumbnail needn't be a multiple of 4 bytes, which is what QImage assumes without bytesPerLine.
+        fromImage copies, so gray needn't outlive the pixmap.
+        """
+        im = QtGui.QImage(gray.data, w, h, gray.strides[0], QtGui.QImage.Format_Indexed8)
         return QtGui.QPixmap.fromImage(im), gray
 
+    def _show_on_live_screen(self, frame, iwin, lut, pixel_bits):
+        """
+        Show a full-size frame on the live screen, windowed by the screen itself (OpenGL backend) or as a pixmap.
+        """
+        if self.config.live_backend == 'opengl':
+            self.live_screen.set_frame(frame, iwin, 2**pixel_bits)
+        else:
+            pix, gray = self._get_pixmap(frame, iwin, lut, pixel_bits)
+            self.live_screen.setPixmap(pix)
+
     def _cap_title(self, ndx):
         """
         format the string for titling the live or capture frame
@@ -856,30 +1234,21 @@ class Viewer(QtWidgets.QMainWindow):
         in display param
         """
 
-        fn = self._get_cap_filename()
-        try:
-            im = PIL.Image.open(fn)
-        except FileNotFoundError:
-            return
-
-        frame = np.array(im)
-
-        """
-        frame = cv2.imread(fn, cv2.IMREAD_ANYDEPTH)
-        if (frame is None):
-            return
-        """
-
-        frame = (frame >> (16 - self.camera.pixel_bits)).astype(np.uint16)
-
         ndx = self.dpar.cur_cap
+        if ndx is None:
+            return
 
         if self.dpar.cap_live_swap:
-            pix, gray = self._get_pixmap(frame, self.dpar.iwindow[ndx])
+            frame = self.dpar.cap_store.full(ndx)
+            if frame is None:
+                return
             self.live_screen.live_title = self._cap_title(ndx)
-            self.live_screen.setPixmap(pix)
+            self._show_on_live_screen(frame, self.dpar.iwindow[ndx], self.cap_lut, self.dpar.pixel_bits[ndx])
         else:
-            pix, gray = self._get_pixmap(frame[::4,::4], self.dpar.iwindow[ndx])
+            thumb = self.dpar.cap_store.thumbnail(ndx)
+            if thumb is None:
+                return
+            pix, gray = self._get_pixmap(thumb, self.dpar.iwindow[ndx], self.cap_lut, self.dpar.pixel_bits[ndx])
             self.cap_screen.cap_title = self._cap_title(ndx)
             self.cap_screen.setPixmap(pix)
             self.cap_screen.format_for_cap()    # This is because first time, format is for "no stills".
@@ -891,14 +1260,14 @@ class Viewer(QtWidgets.QMainWindow):
         Parameters
         ----------
         fps : (float)
-            the (smoothed)
+            the (smoothed) acquired frame rate.  The rendered frame rate is shown after it.
         Returns
         -------
 
         """
 
         et = np.int(np.round(self.camera.actual_exposure_time_ms))
-        return 'Live %d ms %.2f FPS' % (et, fps)
+        return 'Live %d ms %.2f FPS (shown %.1f)' % (et, fps, self.display_scheduler.fps)
 
 
     def update_frame(self, frame):
@@ -910,69 +1279,54 @@ class Viewer(QtWidgets.QMainWindow):
         Convert the 2D numpy array `gray` into a 8-bit QImage with a gray
         colormap.  The first dimension represents the vertical image axis.
         http://www.mail-archive.com/pyqt@riverbankcomputing.com/msg17961.html
+
+        `frame` is a pooled Frame.  The camera only guarantees it for the duration of the call, the reference kept in
+        dpar.latest holds it until the next frame arrives, so no copies are needed.
+
+        Every frame is corrected (or goes to the calibration) and recorded.  Display is left to the display
+        scheduler, which renders at most DisplayMaxFps frames a second and nothing while the window is minimized.
         """
 
         t = datetime.now()
         delta_t = t - self.dpar.frame_timestamp[0]
-        fps = self.dpar.update_fps(1./delta_t.total_seconds())
+        self.dpar.update_fps(1./delta_t.total_seconds())
 
         self.dpar.frame_timestamp[0] = t
 
         if self.config.black_correct:
-            cframe = self.ffc.black_correct(frame)
+            self.dpar.set_latest(self.ffc.black_correct(frame))
         else:
-            cframe = frame
+            self.dpar.set_latest(frame.acquire())
 
-        self.dpar.latest_frame = np.copy(cframe)
-        
-        if self.dpar.cap_live_swap:
-            pix, gray = self._get_pixmap(cframe[::4,::4], self.dpar.iwindow[0])
-            self.cap_screen.cap_title = self._live_title(fps)
-            self.cap_screen.setPixmap(pix)
-        else: 
-            pix, gray = self._get_pixmap(cframe, self.dpar.iwindow[0])
-            self.live_screen.live_title = self._live_title(fps)
-            self.live_screen.setPixmap(pix)
+        """
+        With denoise on, the average replaces the corrected frame as the latest (displayed, captured) frame.  The
+        raw (corrected, unaveraged) frame is held until the end of the call for ROI traces and, if chosen,
+        recording.
+        """
+        raw = self.dpar.latest.acquire()
+        if self.averager.active and not (self.config.black_correct and self.ffc.calibrating):
+            self.dpar.set_latest(self.averager.apply(raw))
+        cframe = self.dpar.latest_frame
+        rec = raw if self.rec_raw_check.isChecked() else self.dpar.latest
 
-        self.draw_histogram()
+        self.display_scheduler.frame_arrived(self._display_visible())
 
+        if self.tracing and self.live_screen.roi_list:
+            self.roi_traces.update(raw.data, frame.timestamp or t, self.live_screen.roi_list)
 
         if self.recording_sequence:
 
-            # MRP ToDo update these tags properly.
             et = np.int(np.round(self.camera.actual_exposure_time_ms))
             ifi_ms = 1000. / self.camera.actual_frame_rate
             ts_ms = np.int(np.round(ifi_ms * self.seq_frame_num))
 
-            self.ifd.update_tags((self.seq_frame_num, 0), et, 0, ts_ms, 99)
-
-            cap_image = np.copy(self.dpar.latest_frame).astype(np.uint16)
-            #cv2.imwrite(cfn, (cap_image << (16 - self.camera.pixel_bits)).astype(np.uint16))
-
-            """
-            Perform the TIFF windowing and then rebinning (compress) according to config file options
-            """
-            x0 = max(0, (cap_image.shape[1] - config.tiff_seq_x_window) // 2)
-            x1 = cap_image.shape[1] - x0
-            y0 = max(0, (cap_image.shape[0] - config.tiff_seq_y_window) // 2)
-            y1 = cap_image.shape[0] - y0
-            cap_image = cap_image[y0:y1, x0:x1]
-
-            shift_bits = 16 - self.camera.pixel_bits
-            if config.tiff_seq_rebin > 1:   # not tested for r ne 2
-                r = config.tiff_seq_rebin
-                cap_image = cap_image.reshape((cap_image.shape[0] // r, r, cap_image.shape[1] // r, -1)).sum(axis=3).sum(axis=1)
-                extra_bits = 2 * (r.bit_length() -1)
-                shift_bits = max(0, shift_bits - extra_bits)
-
-
-            #im = PIL.Image.fromarray(gray)
-            im = PIL.Image.fromarray((cap_image << shift_bits).astype(np.uint16))
-
-            im.save(self.tiff_out, tiffinfo=self.ifd, compression=TIFF_COMPRESSION)
-            self.tiff_out.newFrame()
+            self.recorder.put(rec, et, ts_ms)
             self.seq_frame_num += 1
-            self.seq_frame_label.setText(str(self.seq_frame_num))
+            self.seq_frame_label.setText(self.recorder.status())
+
+            if self.recorder.error is not None:
+                self.write_to_log('Stack write FAILED: %s' % self.recorder.error)
+                self.record_sequence()
 
         if self.recording_video:
             # cframe is int16
@@ -981,7 +1335,7 @@ class Viewer(QtWidgets.QMainWindow):
             #fc = np.stack((f8, f8, f8), axis=-1)
             #self.rv_vout.write(fc)
             #Style 2&3:
-            self.rv_vout.write(gray)
+            self.rv_vout.write(self.video_lut.apply(rec.data, self.dpar.iwindow[0], 2**rec.pixel_bits))
             self.recorded_video_frame_number += 1
             #Style 4: (16-bit)
             #self.rv_vout.write(cframe)
@@ -989,19 +1343,62 @@ class Viewer(QtWidgets.QMainWindow):
             #if self.recorded_video_frame_number == 20:
             #    self.record_video() # turn off
 
+        raw.release()
+
+    def _display_visible(self):
+        """
+        False if the live display can't be seen: window minimized or not exposed (e.g. covered on platforms that
+        report it), or the screen showing live frames hidden.
+        """
+        window = self.windowHandle()
+        if self.isMinimized() or (window is not None and not window.isExposed()):
+            return False
+        screen = self.cap_screen if self.dpar.cap_live_swap else self.live_screen
+        return screen.isVisible() and not screen.visibleRegion().isEmpty()
+
+    def render_live(self):
+        """
+        Render the latest frame to the live screen (or the capture screen when swapped), with its histogram.
+        Called by the display scheduler.
+        """
+        cframe = self.dpar.latest_frame
+        if cframe is None:
+            return
+        pixel_bits = self.dpar.latest.pixel_bits
+
+        title = self._live_title(self.dpar.fps_estimate)
+        if self.dpar.cap_live_swap:
+            pix, gray = self._get_pixmap(cframe[::4,::4], self.dpar.iwindow[0], self.live_lut, pixel_bits)
+            self.cap_screen.cap_title = title
+            self.cap_screen.setPixmap(pix)
+        else:
+            self.live_screen.live_title = title
+            self._show_on_live_screen(cframe, self.dpar.iwindow[0], self.live_lut, pixel_bits)
+
+        self.draw_histogram()
+        if self.tracing:
+            self.trace_plot.update_plot(self.roi_traces, self.live_screen.roi_list)
+
     def draw_histogram(self):
         """
         Draw the histogram and gain curve into the histogram canvas
         
-        gain curve (gc) shrink factors and offsets are to make the curve
-        match the slider controls
+        gain curve (gc) y shrink factor and offset keep the curve clear of
+        the top and bottom of the plot
         
         Histogram and gain curve axes are normalized (0,1).  Slider settings
-        and iwindows are percentages of the camera's pixel_maxval
-        
+        and iwindows are percentages of the frame's full scale (2**pixel_bits)
+
+        The level counts are kept in self.histogram for the contrast buttons.
         """
 
-        hframe = self.dpar.latest_frame[::4,::4]
+        counts = self.histogram.update(self.dpar.latest_frame, self.dpar.latest.pixel_bits)
+
+        if self.auto_button.isChecked():
+            iwin = self.auto_contrast.track(self.histogram)
+            if iwin is not None:
+                self.dpar.iwindow[0] = iwin
+                self._update_scrollbars()
 
         gcy_shrink = 0.8
         gcy_offset = (1. - gcy_shrink)/2.
@@ -1009,17 +1406,10 @@ class Viewer(QtWidgets.QMainWindow):
         gcurve_x = [0, self.dpar.iwindow[0][0]/100., self.dpar.iwindow[0][1]/100., 1.]
         gcurve_y = [gcy_offset, gcy_offset, 1.-gcy_offset, 1.-gcy_offset]
 
-        hist, bin_edges = np.histogram(hframe.flatten(), bins=HIST_NBINS, range=(0., self.camera.pixel_maxval))
-        hcurve_y = np.array(hist).astype(float) / float(max(hist))
-        #hcurve_x = np.array(bin_edges).astype(float)[0:-1] / 256.
-        hcurve_x = np.arange(HIST_NBINS) / HIST_NBINS
-
+        hist = self.histogram.rebinned(HIST_NBINS)
+        hcurve_y = hist / float(max(hist.max(), 1))
 
-        self.hist_canvas.gain_trace.set_data(gcurve_x, gcurve_y)
-        for hb,hy in zip(self.hist_canvas.hist_bars, hcurve_y):
-            hb.set_height(hy)
-
-        self.hist_canvas.draw()
+        self.hist_canvas.update_plot(hcurve_y, gcurve_x, gcurve_y)
 
 
     def setup_graphics_view(self):
@@ -1029,14 +1419,19 @@ class Viewer(QtWidgets.QMainWindow):
         self.main_widget = QtWidgets.QWidget(self)
         self.setCentralWidget(self.main_widget)
  
-        self.live_screen = LiveScreen((FRAME_HEIGHT,FRAME_WIDTH), parent = self.main_widget)
+        frame_height, frame_width = self.camera.frame_shape
+        if self.config.live_backend == 'opengl':
+            from glscreen import GLLiveScreen
+            self.live_screen = GLLiveScreen((frame_height,frame_width), parent = self.main_widget)
+        else:
+            self.live_screen = LiveScreen((frame_height,frame_width), parent = self.main_widget)
 
         self.cam_label = QtWidgets.QLabel()
         self.cam_label.setAlignment(Qt.AlignCenter)
 
-        self.cap_screen = CapScreen((FRAME_HEIGHT//4,FRAME_WIDTH//4), parent = self.main_widget)
+        self.cap_screen = CapScreen((frame_height//4,frame_width//4), parent = self.main_widget)
 
-        self.hist_canvas = HistCanvas(self.main_widget, dpi=100, height=1.56, width=3.20)
+        self.hist_canvas = HistCanvas(self.main_widget, width=320, height=156)
 
         self.maxi_scrollbar = QtWidgets.QScrollBar(Qt.Horizontal, parent=self.hist_canvas)
         self.maxi_scrollbar.setRange(0, 100)
@@ -1055,9 +1450,15 @@ class Viewer(QtWidgets.QMainWindow):
         self.roi_button.clicked.connect(self.__roi_button_callback)
         self.roi_button.setEnabled(False)
         self.live_screen.connect_roi_button(self.roi_button)
+        self.auto_button = QtWidgets.QPushButton('Auto')
+        self.auto_button.setCheckable(True)
+        self.auto_button.toggled.connect(self.__auto_button_callback)
         self.cal_button = QtWidgets.QPushButton('Cal')
         self.cal_button.clicked.connect(self.__cal_button_callback)
         self.cal_button.setEnabled(self.config.black_correct)
+        self.flat_button = QtWidgets.QPushButton('Flat')
+        self.flat_button.clicked.connect(self.__flat_button_callback)
+        self.flat_button.setEnabled(self.config.black_correct)
 
         self.cap_scrollbar = QtWidgets.QScrollBar(Qt.Horizontal, parent=self.cap_screen)
         self.cap_scrollbar.valueChanged.connect(self.__cap_scrollbar_callback)
@@ -1079,6 +1480,7 @@ class Viewer(QtWidgets.QMainWindow):
         hbox.addWidget(self.reset_button)
         hbox.addWidget(self.global_button)
         hbox.addWidget(self.roi_button)
+        hbox.addWidget(self.auto_button)
         hbox.addStretch(1)
 
         gbox_cb_buttons = QtWidgets.QGroupBox(self)
@@ -1098,7 +1500,8 @@ class Viewer(QtWidgets.QMainWindow):
         exp_panel.addWidget(self.exp2_ifi_select, 1, 3)
         exp_panel.addWidget(QtWidgets.QLabel('s'), 1, 4)
 
-        exp_panel.addWidget(self.cal_button, 0, 5, 2, 1)
+        exp_panel.addWidget(self.cal_button, 0, 5)
+        exp_panel.addWidget(self.flat_button, 1, 5)
 
         hbox = QtWidgets.QHBoxLayout()
         hbox.addStretch(1)
@@ -1132,6 +1535,32 @@ class Viewer(QtWidgets.QMainWindow):
         gbox_led_controls.setTitle('LED Control')
         gbox_led_controls.setLayout(hbox)
 
+        """
+        Live denoise: averaging choice, and whether recordings take the raw or the averaged frames.
+        """
+        self.denoise_select = QtWidgets.QComboBox()
+        for mode, n in DENOISE_CHOICES:
+            self.denoise_select.addItem(_denoise_label(mode, n), (mode, n))
+        choices = list(DENOISE_CHOICES)
+        if self.config.denoise not in choices:
+            choices.append(self.config.denoise)
+            self.denoise_select.addItem(_denoise_label(*self.config.denoise), self.config.denoise)
+        self.denoise_select.setCurrentIndex(choices.index(self.config.denoise))
+        self.denoise_select.currentIndexChanged.connect(self.__denoise_select_callback)
+        self.rec_raw_check = QtWidgets.QCheckBox('Record raw')
+        self.rec_raw_check.setChecked(self.config.denoise_record_raw)
+
+        hbox = QtWidgets.QHBoxLayout()
+        hbox.addStretch(1)
+        hbox.addWidget(QtWidgets.QLabel('Average:'))
+        hbox.addWidget(self.denoise_select)
+        hbox.addWidget(self.rec_raw_check)
+        hbox.addStretch(1)
+
+        gbox_denoise_controls = QtWidgets.QGroupBox()
+        gbox_denoise_controls.setTitle('Denoise')
+        gbox_denoise_controls.setLayout(hbox)
+
         """ 
         Make the capture pallette buttons, put them in an hbox, then into a group.
         """
@@ -1194,6 +1623,34 @@ class Viewer(QtWidgets.QMainWindow):
         gbox_log_controls.setTitle('Log')
         gbox_log_controls.setLayout(vbox)
 
+        """
+        ROI traces: plot of the ROI means and the trace controls.
+        """
+        self.trace_plot = TracePlot(self.main_widget, width=320, height=80)
+
+        self.trace_button = QtWidgets.QPushButton('Trace')
+        self.trace_button.setCheckable(True)
+        self.trace_button.toggled.connect(self.__trace_callback)
+        trace_clear_button = QtWidgets.QPushButton('Clear')
+        trace_clear_button.clicked.connect(self.__trace_clear_callback)
+        trace_save_button = QtWidgets.QPushButton('Save CSV')
+        trace_save_button.clicked.connect(self.__trace_save_callback)
+
+        hbox = QtWidgets.QHBoxLayout()
+        hbox.addStretch(1)
+        hbox.addWidget(self.trace_button)
+        hbox.addWidget(trace_clear_button)
+        hbox.addWidget(trace_save_button)
+        hbox.addStretch(1)
+
+        vbox = QtWidgets.QVBoxLayout()
+        vbox.addWidget(self.trace_plot)
+        vbox.addLayout(hbox)
+
+        gbox_trace_controls = QtWidgets.QGroupBox(self)
+        gbox_trace_controls.setTitle('ROI Traces')
+        gbox_trace_controls.setLayout(vbox)
+
         rhs_panel = QtWidgets.QVBoxLayout()
         rhs_panel.addWidget(self.cam_label)
         rhs_panel.addWidget(self.maxi_scrollbar)
@@ -1202,6 +1659,8 @@ class Viewer(QtWidgets.QMainWindow):
         rhs_panel.addWidget(gbox_cb_buttons)
         rhs_panel.addWidget(gbox_exp_controls)
         rhs_panel.addWidget(gbox_led_controls)
+        rhs_panel.addWidget(gbox_denoise_controls)
+        rhs_panel.addWidget(gbox_trace_controls)
         #rhs_panel.addWidget(self.cap_screen)
         #rhs_panel.addWidget(self.cap_scrollbar)
         rhs_panel.addWidget(gbox_cap_buttons)
@@ -1220,6 +1679,11 @@ class Viewer(QtWidgets.QMainWindow):
         if self.camera is not None:
             self.camera.stop_sampling()
             self.camera.release()
+        if self.recording_sequence:
+            self.recording_sequence = False
+            self.recorder.close(wait=True)
+        self.cap_writer.shutdown()
+        self.dpar.cap_store.shutdown()
 
     def __led_radio_callback(self, checked):
         if not checked: return
@@ -1231,10 +1695,55 @@ class Viewer(QtWidgets.QMainWindow):
             self.camera.led_state('OFF')
 
 
+    def __cap_written_callback(self, frame, fn, err):
+        """
+        Called (on the GUI thread) when the capture writer has finished with a capture.  Log it and drop the writer's
+        reference to the frame.
+        """
+        et = np.int(np.round(frame.exposure_ms))
+        try:
+            self.dpar.cap_store.written(frame)
+        finally:
+            frame.release()
+
+        if err:
+            self.write_to_log('%d\t%s\tWRITE FAILED: %s' % (et, os.path.basename(fn), err))
+        else:
+            self.write_to_log('%d\t%s' % (et, os.path.basename(fn)))
+
     def __log_entry_callback(self):
         self.write_to_log(self.log_entry.text())
         self.log_entry.clear()
 
+    def __denoise_select_callback(self, index):
+        mode, n = self.denoise_select.itemData(index)
+        self.averager.set_mode(mode, n)
+
+    def __trace_callback(self, checked):
+        """
+        Start or stop adding live frames to the ROI traces.  Stopping keeps the traces for saving.
+        """
+        self.tracing = checked
+        self.trace_button.setStyleSheet('background-color:lime' if checked else '')
+
+    def __trace_clear_callback(self):
+        self.roi_traces.clear()
+        self.trace_plot.update_plot(self.roi_traces, [])
+
+    def __trace_save_callback(self):
+        """
+        Write the ROI traces to a CSV file in the session directory and note it in the log.
+        """
+        if not self.roi_traces.buffers:
+            return
+        fn = os.path.join(self._get_session_dir(), 'T%s.csv' % datetime.now().strftime('%H%M%S'))
+        try:
+            self.roi_traces.write_csv(fn)
+        except OSError as err:
+            self.write_to_log('ROI traces WRITE FAILED: %s' % err)
+            return
+        self.write_to_log('ROI traces (%d ROIs)\t%s' % (len(self.roi_traces.buffers), os.path.basename(fn)))
+
 
     def __clear_cap_callback(self):
 
@@ -1278,7 +1787,7 @@ class Viewer(QtWidgets.QMainWindow):
 
             #Style 3: FFV1 (lossless), monochrome. Use VLC media player.
             self.rv_vout = cv2.VideoWriter(fn, cv2.VideoWriter_fourcc(*VIDEO_FORMAT),
-                                           fps=fps, frameSize=(FRAME_WIDTH, FRAME_HEIGHT), isColor=False)
+                                           fps=fps, frameSize=self.camera.frame_shape[::-1], isColor=False)
 
             ifi_ms = self.camera.ifi_settings[self.camera.current_ifi_index]
 
@@ -1334,8 +1843,9 @@ class Viewer(QtWidgets.QMainWindow):
 
             self.seq_frame_num = 0
             self.seq_frame_label.setText('0')
-            self.ifd = doriclib.DoricImageFileDirectory(0)
-            self.tiff_out = PTIP.AppendingTiffWriter(tiffname, True)
+            self.recorder = StackRecorder(tiffname, self.camera.frame_shape,
+                                          self.config.tiff_seq_x_window, self.config.tiff_seq_y_window,
+                                          self.config.tiff_seq_rebin, self.config.tiff_seq_bigtiff)
 
             self.recording_sequence = True
 
@@ -1343,11 +1853,13 @@ class Viewer(QtWidgets.QMainWindow):
             self.rec_seq_button.setStyleSheet("")
             self.capture_button.setEnabled(True)
 
-            self.write_to_log('Stack recording stopped, %d frames.' % self.seq_frame_num)
+            self.write_to_log('Stack recording stopped, %d frames.' % self.recorder.accepted)
+            if self.recorder.dropped > 0:
+                self.write_to_log('%d frames dropped (writer too slow)' % self.recorder.dropped)
             self.seq_frame_label.setText(' ')
 
             self.recording_sequence = False
-            self.tiff_out.close()
+            self.recorder.close()
 
 
     def _update_scrollbars(self):
@@ -1370,33 +1882,62 @@ class Viewer(QtWidgets.QMainWindow):
             self.dpar.iwindow[0][0] = value
 
     def __reset_button_callback(self):
+        self.auto_button.setChecked(False)
         self.dpar.iwindow[0] = [0., 100.]
         self._update_scrollbars()
 
     def __cal_button_callback(self):
 
-        reply = QtWidgets.QMessageBox.question(self, 'Black Calibration',
-                                               'Darken field and press OK to continue',
+        box = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Question, 'Black Calibration',
+                                    'Darken field and press OK to continue.\n'
+                                    'Fast measures a few exposures and fits the rest.',
+                                    QtWidgets.QMessageBox.Ok | QtWidgets.QMessageBox.No, self)
+        fast_button = box.addButton('Fast', QtWidgets.QMessageBox.AcceptRole)
+        box.setDefaultButton(QtWidgets.QMessageBox.Ok)
+        reply = box.exec_()
+
+        if box.clickedButton() == fast_button:
+            self.ffc.start_black_cal(fast=True)
+        elif reply == QtWidgets.QMessageBox.Ok:
+            self.ffc.start_black_cal()
+
+    def __flat_button_callback(self):
+
+        reply = QtWidgets.QMessageBox.question(self, 'Flat Field Calibration',
+                                               'Illuminate a uniform field and press OK to continue',
                                                QtWidgets.QMessageBox.Ok | QtWidgets.QMessageBox.No,
                                                QtWidgets.QMessageBox.Ok)
 
         if reply == QtWidgets.QMessageBox.Ok:
-            self.ffc.start_black_cal()
+            self.ffc.start_gain_cal()
 
-    def _set_contrast(self, f):            
-        scl = 100. / self.camera.pixel_maxval
-        mn = f.min() * scl
-        mx = f.max() * scl
-        self.dpar.iwindow[0] = [mn, mx]
+    def _set_contrast(self, f):
+        """
+        Set the window from the percentiles of pixel values f (e.g. those in an ROI).
+        """
+        self.roi_histogram.update(f, self.dpar.latest.pixel_bits, step=1)
+        self.dpar.iwindow[0] = self.auto_contrast.window(self.roi_histogram)
         self._update_scrollbars()
 
     def __global_button_callback(self):
-        self._set_contrast(self.dpar.latest_frame)
-        
+        if self.histogram.counts is None:
+            return
+        self.dpar.iwindow[0] = self.auto_contrast.window(self.histogram)
+        self._update_scrollbars()
+
+    def __auto_button_callback(self, checked):
+        """
+        Continuous auto-contrast: the window follows the live histogram percentiles (see draw_histogram).
+        """
+        self.auto_contrast.reset()
+        self.auto_button.setStyleSheet('background-color:lime' if checked else '')
+
     def __roi_button_callback(self):
-        mask = self.live_screen.roi_mask()
-        if mask is not None:
-            self._set_contrast(self.dpar.latest_frame[mask])
+        roi = self.live_screen.roi_mask()
+        if roi is not None:
+            window, mask = roi
+            if mask.any():
+                self._set_contrast(self.dpar.latest_frame[window][mask])
 
     def __cap_scrollbar_callback(self, value):
         self.dpar.cur_cap = value
@@ -1491,14 +2032,51 @@ class GetConfig():
         self.exp_init1 = conf.getint('Options', 'ExpInit1', fallback=100)
         self.exp_init2 = conf.getint('Options', 'ExpInit2', fallback=100)
         self.black_correct = conf.getboolean('Options', 'BlackCorrect', fallback=True)
+        self.gain_correct = conf.getboolean('Options', 'GainCorrect', fallback=True)
+        self.defect_correct = conf.getboolean('Options', 'DefectCorrect', fallback=True)
+        self.display_max_fps = conf.getfloat('Options', 'DisplayMaxFps', fallback=15.)
+        self.live_backend = conf.get('Options', 'LiveBackend', fallback='label').lower()
+        if self.live_backend not in ('label', 'opengl'):
+            print('Unknown LiveBackend <%s>, using label' % self.live_backend)
+            self.live_backend = 'label'
+        self.auto_contrast_clip = conf.getfloat('Options', 'AutoContrastClip', fallback=0.1)
+        denoise = conf.get('Options', 'Denoise', fallback='off')
+        try:
+            self.denoise = parse_denoise(denoise)
+        except ValueError:
+            print('Bad Denoise setting <%s>, using off' % denoise)
+            self.denoise = ('off', 1)
+        self.denoise_record_raw = conf.getboolean('Options', 'DenoiseRecordRaw', fallback=False)
+        self.roi_trace_length = conf.getint('Options', 'RoiTraceLength', fallback=8192)
         # Setup square window, default of full-screen height
         self.tiff_seq_x_window = conf.getint('Options', 'TiffSeqXWindow', fallback=cameras.FRAME_HEIGHT)
         self.tiff_seq_y_window = conf.getint('Options', 'TiffSeqYWindow', fallback=cameras.FRAME_HEIGHT)
-        self.tiff_seq_rebin = conf.getint('Options', 'TiffSeqRebin', fallback = 2)
+        self.tiff_seq_bigtiff = conf.getboolean('Options', 'TiffSeqBigTiff', fallback=False)
+        self.acq_thread = conf.getboolean('Options', 'AcqThread', fallback=False)
+        self.cap_cache_mb = conf.getint('Options', 'CapCacheMB', fallback=256)
+        self.seq_buffers = conf.getint('Options', 'SeqBuffers', fallback=cameras.SEQ_BUFFERS_DEFAULT)
+        self.sensor_binning = conf.getint('Options', 'SensorBinning', fallback=1)
+        """
+        Stack rebinning comes on top of any sensor binning, so by default (blank) stacks are only rebinned at full
+        sensor resolution.
+        """
+        rebin = conf.get('Options', 'TiffSeqRebin', fallback='').strip()
+        self.tiff_seq_rebin = int(rebin) if rebin else (2 if self.sensor_binning == 1 else 1)
+        if self.sensor_binning > 1 and self.tiff_seq_rebin > 1:
+            print('Tiff Stacks binned %dx%d: SensorBinning %d, then TiffSeqRebin %d' %
+                  ((self.sensor_binning * self.tiff_seq_rebin,) * 2 + (self.sensor_binning, self.tiff_seq_rebin)))
+        self.pseudo_fps = conf.getfloat('Options', 'PseudoFps', fallback=0.)
+        self.pseudo_seed = conf.getint('Options', 'PseudoSeed', fallback=0)
+        aoi = conf.get('Options', 'SensorAoi', fallback='').strip()
+        try:
+            self.sensor_aoi = tuple(int(v) for v in aoi.split(',')) if aoi else None
+        except ValueError:
+            print('Bad SensorAoi <%s>, using the full sensor' % aoi)
+            self.sensor_aoi = None
 
 def _psetup():
     parser = argparse.ArgumentParser(prog=__PROGRAM_NAME__, description='Patch Clamp Microscopy Camera Interface')
-    parser.add_argument('mode', type=int, default = None, help='Mode, 0=UC480, 1=WebCam, 2=Pseudo random noise')
+    parser.add_argument('mode', type=int, default = None, help='Mode, 0=UC480, 1=WebCam, 2=Pseudo (synthetic scene)')
     parser.add_argument('-v', '--version', action='version', version='%(prog)s {version}'.format(version=__VERSION__))
 
     return parser
@@ -0,0 +1,434 @@
+"""
+Calibration data for FlatFieldCal.
+
+Dark frames for all exposures are kept in a single memory-mapped file: a fixed-size versioned header (exposure list,
+camera serial number, per-exposure calibration time stamps) followed by an (exposures, height, width) int16 array.
+Opening it only maps the file, so start-up is instant and only the pages of the exposures actually used are read.
+Gain (flat-field) maps and the dark noise (temporal standard deviation) maps measured with the dark frames are kept
+the same way, as float32, in their own files.
+
+Binned or AOI readouts are calibrated separately, in files named for the readout mode (see cal_filename).
+"""
+import json
+import struct
+from datetime import datetime
+
+import numpy as np
+
+CAL_FILENAME = 'BLACK.cal'
+GAIN_FILENAME = 'GAIN.cal'
+NOISE_FILENAME = 'NOISE.cal'
+CAL_MAGIC = b'PCMCAL'
+CAL_VERSION = 1
+CAL_HEADER_SIZE = 4096      # magic, version (uint16), JSON header padded with blanks
+CAL_DTYPE = '<i2'
+GAIN_DTYPE = '<f4'
+
+GAIN_MIN_LEVEL = 0.05       # pixels darker than this fraction of the mean flat aren't gain corrected
+FLAT_LEVEL_RANGE = (0.1, 0.8)   # usable mean flat level, as a fraction of full scale
+
+FAST_CAL_EXPOSURES = (20, 140, 1000, 4000)    # ms, exposures measured by the fast dark calibration
+FAST_CAL_MIN_AVERAGES = 4   # frames, at least, so the fast calibration measures the variance of each exposure
+
+# Defect pixel map bits, see pixel_defects
+DEFECT_HOT = 1              # dark level far above the typical dark level
+DEFECT_NOISY = 2            # dark noise far above the typical dark noise
+DEFECT_DEAD = 4             # stuck, no dark noise at all
+DEFECT_SIGMA = 8.           # hot threshold, in units of the typical dark noise
+DEFECT_NOISE_FACTOR = 5.    # noisy threshold, multiple of the typical dark noise
+DEFECT_DEAD_MIN_NOISE = 0.5     # only look for stuck pixels if the typical dark noise is at least this (LSB)
+
+
+class DarkCalFile(object):
+    """
+    Memory-mapped dark calibration file.
+
+    Attributes
+    ----------
+    black : np.memmap
+        (exposures, height, width) dark frames.  Index it like the list of arrays it replaces.
+    header : dict
+        'version', 'dtype', 'exposures' (ms), 'serial', 'created' and 'timestamps' (per exposure, None if never
+        calibrated)
+    """
+    DTYPE = CAL_DTYPE
+
+    def __init__(self, path, mode='r+'):
+        """
+
+        Parameters
+        ----------
+        path : str
+        mode : str
+            np.memmap mode: 'r+' writes changes through to the file, 'c' keeps them in memory (copy-on-write).
+
+        Raises
+        ------
+        ValueError
+            if the file is not a calibration file of a supported version
+        """
+        with open(path, 'rb') as f:
+            head = f.read(CAL_HEADER_SIZE)
+        if len(head) < CAL_HEADER_SIZE or head[:len(CAL_MAGIC)] != CAL_MAGIC:
+            raise ValueError('not a calibration file')
+        version, = struct.unpack('<H', head[len(CAL_MAGIC):len(CAL_MAGIC) + 2])
+        if version != CAL_VERSION:
+            raise ValueError('unsupported calibration file version %d' % version)
+        header = json.loads(head[len(CAL_MAGIC) + 2:].decode('utf-8'))
+        if header.get('dtype', CAL_DTYPE) != self.DTYPE:
+            raise ValueError('calibration file holds %s, not %s' % (header.get('dtype'), self.DTYPE))
+
+        self.path = path
+        self.writable = mode == 'r+'
+        self.header = header
+        self.black = np.memmap(path, dtype=self.DTYPE, mode=mode, offset=CAL_HEADER_SIZE,
+                               shape=tuple(self.header['shape']))
+
+    @classmethod
+    def create(cls, path, exposures, shape, serial):
+        """
+        Create a new, all-zero calibration file and open it for writing.  The data area is left sparse so this is
+        quick.
+
+        Parameters
+        ----------
+        path : str
+        exposures : sequence of int
+            exposure settings (ms), one dark frame each
+        shape : (int, int)
+            frame shape
+        serial : str
+            camera serial number
+        """
+        header = {'version': CAL_VERSION,
+                  'dtype': cls.DTYPE,
+                  'shape': [len(exposures)] + list(shape),
+                  'exposures': list(exposures),
+                  'serial': serial,
+                  'created': datetime.now().isoformat(timespec='seconds'),
+                  'timestamps': [None] * len(exposures)}
+
+        with open(path, 'wb') as f:
+            f.write(_pack_header(header))
+            f.truncate(CAL_HEADER_SIZE + int(np.prod(header['shape'])) * np.dtype(cls.DTYPE).itemsize)
+
+        return cls(path, 'r+')
+
+    @property
+    def exposures(self):
+        return self.header['exposures']
+
+    @property
+    def serial(self):
+        return self.header['serial']
+
+    def calibrated(self, ndx):
+        """
+        True if exposure index ndx has been calibrated.
+        """
+        return self.header['timestamps'][ndx] is not None
+
+    def matches(self, exposures, shape):
+        """
+        True if this file holds dark frames for exactly these exposures and frame shape.
+        """
+        return list(self.exposures) == list(exposures) and tuple(self.header['shape'][1:]) == tuple(shape)
+
+    def store(self, ndx, frame):
+        """
+        Replace the dark frame for exposure index ndx and stamp it.  Written through to disk if the file is writable.
+        """
+        self.black[ndx] = frame
+        self.header['timestamps'][ndx] = datetime.now().isoformat(timespec='seconds')
+        if self.writable:
+            self.black.flush()
+            with open(self.path, 'r+b') as f:
+                f.write(_pack_header(self.header))
+
+
+class NoiseCalFile(DarkCalFile):
+    """
+    Memory-mapped dark noise file: per-pixel temporal standard deviation of the dark frames, float32, also
+    accessible as ``noise``.
+    """
+    DTYPE = GAIN_DTYPE
+
+    @property
+    def noise(self):
+        return self.black
+
+
+class GainCalFile(DarkCalFile):
+    """
+    Memory-mapped gain calibration file.  The same layout as DarkCalFile but holding float32 gain maps, which are
+    also accessible as ``gain``.
+    """
+    DTYPE = GAIN_DTYPE
+
+    @property
+    def gain(self):
+        return self.black
+
+
+class PixelStats(object):
+    """
+    Running per-pixel mean and variance of a frame sequence (Welford's algorithm), in float64 so any number of frames
+    can be averaged without overflow or loss of precision.  Nothing is allocated per frame.
+    """
+
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)           # sum of squared differences from the mean
+        self._delta = np.empty(shape)
+        self._delta2 = np.empty(shape)
+
+    def reset(self):
+        self.n = 0
+        self.mean.fill(0.)
+        self.m2.fill(0.)
+
+    def add(self, frame):
+        self.n += 1
+        np.subtract(frame, self.mean, out=self._delta)
+        np.multiply(self._delta, 1. / self.n, out=self._delta2)
+        self.mean += self._delta2
+        np.subtract(frame, self.mean, out=self._delta2)
+        self._delta *= self._delta2
+        self.m2 += self._delta
+
+    def rounded_mean(self, out):
+        """
+        Mean rounded into out (e.g. an int16 dark frame).
+        """
+        return np.rint(self.mean, out=out, casting='unsafe')
+
+    def std(self, out):
+        """
+        Sample standard deviation into out (e.g. float32).
+        """
+        np.divide(self.m2, max(self.n - 1, 1), out=out, casting='unsafe')
+        return np.sqrt(out, out=out)
+
+
+def pixel_defects(black, noise, out=None):
+    """
+    Classify defect pixels from a dark frame and its noise map.  Thresholds are relative to the typical (median)
+    dark level and noise, so they adapt to exposure time.
+
+    Parameters
+    ----------
+    black : ndarray
+        dark frame
+    noise : ndarray
+        dark noise (standard deviation) for the same exposure
+    out : ndarray
+        uint8 result, allocated if None
+
+    Returns
+    -------
+    defects : ndarray
+        uint8 map of DEFECT_HOT | DEFECT_NOISY | DEFECT_DEAD bits, 0 for good pixels.
+    """
+    if out is None:
+        out = np.empty(black.shape, np.uint8)
+    level = np.median(black)
+    spread = max(float(np.median(noise)), 1.)     # dark noise is often below one LSB at short exposures
+
+    np.greater(black, level + DEFECT_SIGMA * spread, out=out)
+    out |= (noise > DEFECT_NOISE_FACTOR * spread).view(np.uint8) * np.uint8(DEFECT_NOISY)
+    if np.median(noise) >= DEFECT_DEAD_MIN_NOISE:
+        out |= (noise == 0).view(np.uint8) * np.uint8(DEFECT_DEAD)
+    return out
+
+
+class DefectPixels(object):
+    """
+    Replaces defect pixels by the median of their 3x3 neighbourhood.  The pixel list and neighbour gather indices
+    are computed once, so correcting a frame only touches the listed pixels and their neighbours.
+
+    Neighbours outside the frame or themselves defective are replaced by the neighbour on the opposite side (or,
+    failing that, any good neighbour), so every defect always has 8 values to take the median of.
+    """
+
+    def __init__(self, defects):
+        """
+
+        Parameters
+        ----------
+        defects : ndarray
+            defect map, non-zero for pixels to replace (e.g. from pixel_defects)
+        """
+        h, w = defects.shape
+        self.shape = defects.shape
+        self.index = np.flatnonzero(defects)            # flat indices of the defect pixels
+        bad = defects.ravel() != 0
+        y, x = np.divmod(self.index, w)
+
+        offsets = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx]
+        nbr = np.empty((len(self.index), len(offsets)), np.intp)
+        ok = np.empty(nbr.shape, bool)
+        for k, (dy, dx) in enumerate(offsets):
+            ny, nx = y + dy, x + dx
+            inside = (ny >= 0) & (ny < h) & (nx >= 0) & (nx < w)
+            nbr[:, k] = np.where(inside, ny * w + nx, 0)
+            ok[:, k] = inside & ~bad[nbr[:, k]]
+
+        mirror = len(offsets) - 1 - np.arange(len(offsets))     # offsets are symmetric: k <-> 7 - k
+        first_ok = np.where(ok.any(axis=1), nbr[np.arange(len(nbr)), ok.argmax(axis=1)], self.index)
+        self.neighbours = np.where(ok, nbr, np.where(ok[:, mirror], nbr[:, mirror], first_ok[:, None]))
+
+        self._gather = None         # neighbour values, in the frame's dtype
+        self._median = np.empty(len(self.index), np.float64)
+
+    def __len__(self):
+        return len(self.index)
+
+    def apply(self, frame):
+        """
+        Replace the defect pixels of frame (C-contiguous, this shape), in place.
+        """
+        if len(self.index) == 0:
+            return frame
+        flat = frame.reshape(-1)
+        if self._gather is None or self._gather.dtype != frame.dtype:
+            self._gather = np.empty(self.neighbours.shape, frame.dtype)
+        np.take(flat, self.neighbours, out=self._gather)
+        np.median(self._gather, axis=1, out=self._median, overwrite_input=True)
+        np.rint(self._median, out=self._median)
+        flat[self.index] = self._median
+        return frame
+
+
+def fit_linear(t, frames, n=None):
+    """
+    Per-pixel least-squares fit of ``n * offset + rate * t`` to frames measured at times t, each the sum of n camera
+    frames.  Used to model dark level (and dark variance) against exposure time: both are a fixed part per frame
+    summed plus a part growing with the dark current over the whole exposure.
+
+    Parameters
+    ----------
+    t : sequence of float
+        exposure times
+    frames : sequence of ndarray
+        one frame (e.g. mean dark frame) per time
+    n : sequence of int
+        frames summed in each exposure, all 1 if None
+
+    Returns
+    -------
+    offset, rate : ndarray
+        float32 per-pixel fit, offset per summed frame
+
+    Raises
+    ------
+    ValueError
+        fewer than two independent exposures (distinct t / n), so offset and rate can't be separated
+    """
+    t = np.asarray(t, np.float64)
+    n = np.ones_like(t) if n is None else np.asarray(n, np.float64)
+
+    """
+    Normal equations of the two-parameter fit.  The solution is a fixed weighted sum of the frames, so the frames
+    are accumulated in one pass.
+    """
+    snn, snt, stt = np.dot(n, n), np.dot(n, t), np.dot(t, t)
+    det = snn * stt - snt * snt
+    if len(t) < 2 or det <= 1e-9 * snn * stt:
+        raise ValueError('linear fit needs two or more exposures of distinct time per frame, got %s' %
+                         ', '.join('%g ms / %d' % tn for tn in zip(t, n)))
+    w_offset = (stt * n - snt * t) / det
+    w_rate = (snn * t - snt * n) / det
+
+    offset = np.zeros(frames[0].shape, np.float64)
+    rate = np.zeros(frames[0].shape, np.float64)
+    for wo, wr, f in zip(w_offset, w_rate, frames):
+        offset += f * wo
+        rate += f * wr
+
+    return offset.astype(np.float32), rate.astype(np.float32)
+
+
+def gain_map(flat, black, out):
+    """
+    Gain map from an averaged flat (uniformly illuminated) frame: the reciprocal of the dark-corrected flat,
+    normalized to mean 1, so correction is a single multiply.
+
+    Parameters
+    ----------
+    flat : ndarray
+        mean of the flat frames
+    black : ndarray
+        dark frame for the same exposure
+    out : ndarray
+        float32 result
+
+    Returns
+    -------
+    level : float
+        mean dark-corrected flat level.  Pixels below GAIN_MIN_LEVEL of this (dead, or outside the illuminated field)
+        get gain 1.
+    """
+    np.subtract(flat, black, out=out)
+    level = float(out.mean())
+    valid = out > GAIN_MIN_LEVEL * level
+    np.divide(level, out, out=out, where=valid)
+    out[~valid] = 1.
+    return level
+
+
+def cal_filename(fn, readout_tag):
+    """
+    Name of a calibration file for a camera readout mode, e.g. BLACK_b2.cal.  Full-frame readout ('' tag) keeps the
+    plain name.
+    """
+    if not readout_tag:
+        return fn
+    root, ext = fn.rsplit('.', 1)
+    return '%s_%s.%s' % (root, readout_tag, ext)
+
+
+def _pack_header(header):
+    head = CAL_MAGIC + struct.pack('<H', CAL_VERSION) + json.dumps(header).encode('utf-8')
+    if len(head) > CAL_HEADER_SIZE:
+        raise ValueError('calibration header too long')
+    return head.ljust(CAL_HEADER_SIZE, b' ')
+
+
+def correct_frame(frame, black, out, gain=None, scratch=None, maxval=None):
+    """
+    Dark (and optionally gain) correct a frame into a preallocated buffer: ``max(0, (frame - black) * gain)``.
+    Nothing is allocated, so this is safe to call on every live frame.
+
+    Parameters
+    ----------
+    frame : ndarray
+        raw int16 frame
+    black : ndarray
+        int16 dark frame, same shape
+    out : ndarray
+        int16 result.  May be ``frame`` itself to correct in place.
+    gain : ndarray
+        float32 gain map (mean 1), or None for dark correction only
+    scratch : ndarray
+        float32 work buffer, same shape, required with gain.
+    maxval : int
+        full scale the gain corrected frame is clipped to (the largest value of ``out``'s type if None), so a gain
+        above 1 saturates bright pixels rather than overflowing.
+
+    Returns
+    -------
+    out : ndarray
+    """
+    if gain is None:
+        np.subtract(frame, black, out=out)
+        np.maximum(out, 0, out=out)     # saturate: dark noise may exceed the signal
+    else:
+        if maxval is None:
+            maxval = np.iinfo(out.dtype).max
+        np.subtract(frame, black, out=scratch)
+        scratch *= gain
+        np.rint(scratch, out=scratch)   # round, truncation would bias every pixel down half a level
+        np.clip(scratch, 0, maxval, out=scratch)
+        np.copyto(out, scratch, casting='unsafe')
+    return out
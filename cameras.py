@@ -7,17 +7,24 @@ Created on Thu May 19 15:02:34 2016
 
 import ueye_util as uu
 
+import threading
+from datetime import datetime
+
 import cv2
 from PyQt5 import QtCore
 import numpy as np
 from pyueye import ueye
 
-from ctypes import sizeof, c_char_p, byref
-from ctypes.wintypes import INT, UINT, DOUBLE, HWND
+from frames import FramePool
+from synthetic import SyntheticScene
+
+from ctypes import sizeof, c_char_p, c_void_p, byref, cast, windll
+from ctypes.wintypes import INT, UINT, DOUBLE, HWND, HANDLE
 
 # Don't remember how I got these:
 WM_USER = 0x400
 UC480_MESSAGE = WM_USER + 0x0100
+WAIT_OBJECT_0 = 0           # WaitForSingleObject: the event was signalled
 
 FRAME_WIDTH = 1280
 FRAME_HEIGHT = 1024
@@ -27,6 +34,16 @@ COLOR_MODE = ueye.IS_CM_MONO10
 
 UC480_PIXEL_CLOCK_TO_USE = 24  # Note - not all values allowed.  This allows frames up to 1.27 s.
 
+ACQ_RING_SIZE = 4           # frames in flight to the GUI in threaded acquisition mode
+ACQ_WAIT_TIMEOUT_MS = 500   # acquisition thread wakes at least this often to check for a stop request
+SEQ_BUFFERS_DEFAULT = 4     # driver image memories in the capture sequence (1 = single buffer, no sequence)
+
+UC480_BINNINGS = (1, 2, 4)  # sensor binning factors supported (same horizontally and vertically)
+UC480_AOI_STEP = 8          # AOI position and size granularity, in binned pixels
+
+UC480_PIXEL_BITS = 10       # sensor depth in the 10-bit i/f mode
+SUM_MAX_BITS = 15           # most bits in a summed (multi-frame) exposure, so sums fit the int16 frames
+
 """
 Dfinitions for Camera parent and subclasses
 
@@ -50,12 +67,41 @@ class Camera(object):
         self.ifi_settings = (0, 200, 500, 1000, 2000, 5000, 10000, 20000, 60000) # current limit
         self.exposure_settings = ( 20, 28, 40, 57, 80, 100, 140, 200, 280, 400, 570, 800, 1000, 1400, 2000, 2800, 4000)
         self.black_cal_averages = (20, 28, 10, 10, 10,  10,  10,  10,  10,   5,   5,   5,    4,    2,    2,    1,    1)
+        self.exposure_frames = (1,) * len(self.exposure_settings)  # frames summed for each exposure setting
         self.default_exposure_index = 5
         self.current_exposure_index = self.default_exposure_index
         self.current_ifi_index = 0
         self.actual_exposure_time_ms = 0.
         self.actual_frame_rate = 1.
         self.cal_active = False
+        self.frame_shape = (FRAME_HEIGHT, FRAME_WIDTH)     # (rows, columns) of the frames delivered
+        self.readout_tag = ''   # names the readout mode (binning, AOI) in calibration file names, '' for full frame
+        self.pool = FramePool(self.frame_shape, np.int16)
+        self.frame_seq = 0
+
+    def _new_frame(self):
+        """
+        Take a frame from the pool and stamp it with the current exposure, pixel depth, time and sequence number.
+
+        Returns
+        -------
+        frame : Frame
+            frame with one reference, owned by the caller
+        """
+        frame = self.pool.get()
+        frame.exposure_ms = self.actual_exposure_time_ms
+        frame.pixel_bits = self.pixel_bits
+        frame.timestamp = datetime.now()
+        frame.seq = self.frame_seq
+        self.frame_seq += 1
+        return frame
+
+    def _emit_frame(self, frame):
+        """
+        Pass a frame to the callback and drop the camera's reference.  The callback must acquire the frame to keep it.
+        """
+        self.uf_callback(frame)
+        frame.release()
 
     def set_cal_state(self, cal_on):
         """
@@ -90,9 +136,58 @@ class Camera(object):
         pass
 
 
+class _AcqWorker(QtCore.QThread):
+    """
+    Acquisition thread for the UC480 camera.
+
+    Waits on the driver's frame event (a Win32 event registered with is_InitEvent) and has the camera copy (and, for
+    multi-frame exposures, sum) the image into a pooled frame.  Completed frames are handed to the GUI thread with the
+    ``frame_ready`` signal, so copying never waits on the Qt event loop.
+    """
+    frame_ready = QtCore.pyqtSignal(object)
+
+    def __init__(self, camera):
+        super().__init__()
+        self.camera = camera
+        self.running = False
+
+    def run(self):
+        while self.running:
+            ret = windll.kernel32.WaitForSingleObject(self.camera.frame_event, ACQ_WAIT_TIMEOUT_MS)
+            if ret != WAIT_OBJECT_0:     # time-out, e.g. between ticks in still mode
+                continue
+            while self.running:     # events don't queue up, so drain any completed sequence buffers
+                frame = self.camera._acquire()
+                if frame is not None:
+                    self.frame_ready.emit(frame)
+                if self.camera.seq_pending() == 0:
+                    break
+
+    def stop(self):
+        self.running = False
+        self.wait()
+
+
 class UC480_Camera(Camera):
-    def __init__(self):
+    def __init__(self, acq_thread=False, seq_buffers=SEQ_BUFFERS_DEFAULT, binning=1, aoi=None):
+        """
+
+        Parameters
+        ----------
+        acq_thread : bool
+            if True, frames are acquired by a worker thread waiting on driver events instead of being copied on the
+            GUI thread in response to Windows messages.
+        seq_buffers : int
+            number of driver image memories to register as a capture sequence.  The driver fills them in turn so a
+            frame arriving while the previous one is being copied doesn't overwrite it.
+        binning : int
+            sensor binning, one of UC480_BINNINGS
+        aoi : (int, int, int, int)
+            sensor area of interest (x, y, width, height) in sensor (unbinned) pixels, None for the full sensor.
+            Position and size must be multiples of UC480_AOI_STEP binned pixels.
+        """
         super().__init__()
+        self._set_readout(binning, aoi)
 
         self.hCam = ueye.HIDS(0)  # 0: first available camera;  1-254: The camera with the specified camera ID
         self.sInfo = ueye.SENSORINFO()
@@ -147,17 +242,99 @@ class UC480_Camera(Camera):
                           (0.7, 1400., 2),
                           (0.5, 2000., 2))
         assert len(self.exp_param) == len(self.exposure_settings)
-        self.max_max_frame = max([ep[2] for ep in self.exp_param])
+        self.exposure_frames = tuple(ep[2] for ep in self.exp_param)
         self.frame_ptr = 0
 
         """
-        Internal buffer for this camera only. Needed for the longer exposure times
+        Summation buffers for multi-frame exposures (navg > 1): each image is read into sum_image and added into
+        the int32 sum_acc as it arrives, so any navg costs the same per frame and nothing saturates.
         """
-        self.frame = np.zeros((self.max_max_frame, FRAME_HEIGHT, FRAME_WIDTH), dtype=np.int16, order='C')
+        self.sum_image = np.zeros(self.frame_shape, dtype=np.int16, order='C')
+        self.sum_acc = np.zeros(self.frame_shape, dtype=np.int32, order='C')
 
-        self.pixel_bits = 10       # 10-bit i/f mode
+        self.pixel_bits = UC480_PIXEL_BITS       # 10-bit i/f mode, more for summed exposures (see _set_sum_depth)
         self.pixel_maxval = 2**self.pixel_bits
+        self.sum_shift = 0
+
+        """
+        Threaded acquisition: the worker takes an acq_free slot for each frame it hands over, the GUI gives it back
+        once the frame callback has returned.  If the GUI falls ACQ_RING_SIZE frames behind, frames are dropped (and
+        counted) rather than queued without limit.
+        """
+        self.acq_thread = acq_thread
+        self.acq_worker = None
+        self.acq_lock = threading.Lock()   # guards frame_ptr and the summation buffer
+        self.acq_free = threading.Semaphore(ACQ_RING_SIZE)
+        self.acq_dropped = 0        # frames dropped because the GUI had ACQ_RING_SIZE frames in hand
+        self.frame_event = None     # Win32 event signalled by the driver for each frame (threaded acquisition)
+
+        """
+        Driver capture sequence: list of (mem, id, address) for each image memory.  Empty if running on the single
+        image memory.  seq_next is the next buffer to read, None to re-synchronize to the last completed buffer.
+        seq_read is the driver's frame number of the last buffer read, so the fill is a frame count rather than ring
+        index arithmetic (which can't tell a full ring from an empty one).
+        """
+        self.seq_buffers = seq_buffers
+        self.seq_mem = []
+        self.seq_next = None
+        self.seq_read = 0
+        self.seq_stats = {'frames': 0, 'fill': 0, 'max_fill': 0, 'full': 0}
+
 
+    def _set_readout(self, binning, aoi):
+        """
+        Check and record the readout mode, and size the frames for it.  The sensor is set up in connect.
+
+        Raises
+        ------
+        ValueError
+            unsupported binning, or an AOI off the sensor or not on the AOI grid
+        """
+        if binning not in UC480_BINNINGS:
+            raise ValueError('Binning must be one of %s, not %s' % (UC480_BINNINGS, binning))
+        full = (0, 0, FRAME_WIDTH, FRAME_HEIGHT)
+        aoi = full if aoi is None else tuple(aoi)
+        if len(aoi) != 4:
+            raise ValueError('AOI must be x, y, width, height, not %s' % (aoi,))
+        x, y, w, h = aoi
+        step = UC480_AOI_STEP * binning
+        if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > FRAME_WIDTH or y + h > FRAME_HEIGHT:
+            raise ValueError('AOI %s is not within the %dx%d sensor' % (aoi, FRAME_WIDTH, FRAME_HEIGHT))
+        if any(v % step for v in aoi):
+            raise ValueError('AOI %s must be on a %d pixel grid with %dx binning' % (aoi, step, binning))
+
+        self.binning = binning
+        self.aoi = aoi
+        self.frame_shape = (h // binning, w // binning)
+        tags = ['b%d' % binning] if binning > 1 else []
+        if aoi != full:
+            tags.append('%dx%d_%d_%d' % (w, h, x, y))
+        self.readout_tag = '_'.join(tags)
+        self.readout_speedup = float(FRAME_WIDTH * FRAME_HEIGHT) / (w * h)   # fewer rows and pixels to read
+        self.pool = FramePool(self.frame_shape, np.int16)
+
+    def _setup_readout(self):
+        """
+        Program the sensor binning and AOI.  The AOI is given to the driver in binned pixels.
+        """
+        if self.binning == 2:
+            nRet = ueye.is_SetBinning(self.hCam, ueye.IS_BINNING_2X_VERTICAL | ueye.IS_BINNING_2X_HORIZONTAL)
+        elif self.binning == 4:
+            nRet = ueye.is_SetBinning(self.hCam, ueye.IS_BINNING_4X_VERTICAL | ueye.IS_BINNING_4X_HORIZONTAL)
+        else:
+            nRet = ueye.is_SetBinning(self.hCam, ueye.IS_BINNING_DISABLE)
+        if nRet != ueye.IS_SUCCESS:
+            raise SystemError("is_SetBinning ERROR")
+
+        x, y, w, h = [v // self.binning for v in self.aoi]
+        rect = ueye.IS_RECT()
+        rect.s32X = ueye.int(x)
+        rect.s32Y = ueye.int(y)
+        rect.s32Width = ueye.int(w)
+        rect.s32Height = ueye.int(h)
+        nRet = ueye.is_AOI(self.hCam, ueye.IS_AOI_IMAGE_SET_AOI, rect, ueye.sizeof(rect))
+        if nRet != ueye.IS_SUCCESS:
+            raise SystemError("is_AOI ERROR")
 
     def connect(self, win_id):
 
@@ -166,15 +343,24 @@ class UC480_Camera(Camera):
         if nRet != ueye.IS_SUCCESS:
             raise SystemError("is_ResetToDefault ERROR")
 
+        self._setup_readout()
 
-        #self.api.setup_memory(FRAME_WIDTH, FRAME_HEIGHT, FRAME_BITS_PER_PIXEL)
-        nRet = ueye.is_AllocImageMem(self.hCam, FRAME_WIDTH, FRAME_HEIGHT, FRAME_BITS_PER_PIXEL, self.pcImageMemory, self.MemID)
-        if nRet != ueye.IS_SUCCESS:
-            raise SystemError("is_AllocImageMem ERROR")
 
-        nRet = ueye.is_SetImageMem(self.hCam, self.pcImageMemory, self.MemID)
-        if nRet != ueye.IS_SUCCESS:
-            raise SystemError("is_SetImageMem ERROR")
+        if self.seq_buffers > 1 and self._seq_alloc(self.seq_buffers):
+            print("Image buffers:\t\t", len(self.seq_mem))
+        else:
+            if self.seq_buffers > 1:
+                print("Image sequence refused by driver, using single buffer")
+
+            #self.api.setup_memory(FRAME_WIDTH, FRAME_HEIGHT, FRAME_BITS_PER_PIXEL)
+            nRet = ueye.is_AllocImageMem(self.hCam, self.frame_shape[1], self.frame_shape[0], FRAME_BITS_PER_PIXEL,
+                                         self.pcImageMemory, self.MemID)
+            if nRet != ueye.IS_SUCCESS:
+                raise SystemError("is_AllocImageMem ERROR")
+
+            nRet = ueye.is_SetImageMem(self.hCam, self.pcImageMemory, self.MemID)
+            if nRet != ueye.IS_SUCCESS:
+                raise SystemError("is_SetImageMem ERROR")
 
         nRet = ueye.is_SetColorMode(self.hCam, COLOR_MODE)
         if nRet != ueye.IS_SUCCESS:
@@ -183,10 +369,6 @@ class UC480_Camera(Camera):
 
         pc = uu.set_pixel_clock(self.hCam, UC480_PIXEL_CLOCK_TO_USE)
 
-        #self.api.SetBinning(H.IS_BINNING_2X_HORIZONTAL | H.IS_BINNING_2X_VERTICAL)
-
-        #ueye.is_SetBinning(self.hCam, ueye.IS_BINNING_2X_HORIZONTAL | ueye.IS_BINNING_2X_VERTICAL)
-
         uu.set_flash_active_high(self.hCam)
 
 
@@ -222,9 +404,24 @@ class UC480_Camera(Camera):
         self.timer = QtCore.QTimer()
         self.timer.timeout.connect(self.__tick_callback)
 
-        nRet = uu.is_EnableMessage(self.hCam, ueye.IS_FRAME, win_id)    # Corrected function in utils.
-        if nRet != ueye.IS_SUCCESS:
-            raise SystemError("is_EnableMessage ERROR")
+        if self.acq_thread:
+            self.uses_messages = False
+            self.frame_event = HANDLE(windll.kernel32.CreateEventW(None, False, False, None))   # auto-reset
+            if not self.frame_event:
+                raise SystemError("CreateEvent ERROR")
+            nRet = ueye.is_InitEvent(self.hCam, self.frame_event, ueye.IS_SET_EVENT_FRAME)
+            if nRet != ueye.IS_SUCCESS:
+                raise SystemError("is_InitEvent ERROR")
+            nRet = ueye.is_EnableEvent(self.hCam, ueye.IS_SET_EVENT_FRAME)
+            if nRet != ueye.IS_SUCCESS:
+                raise SystemError("is_EnableEvent ERROR")
+
+            self.acq_worker = _AcqWorker(self)
+            self.acq_worker.frame_ready.connect(self._deliver, QtCore.Qt.QueuedConnection)
+        else:
+            nRet = uu.is_EnableMessage(self.hCam, ueye.IS_FRAME, win_id)    # Corrected function in utils.
+            if nRet != ueye.IS_SUCCESS:
+                raise SystemError("is_EnableMessage ERROR")
 
 
 
@@ -232,6 +429,10 @@ class UC480_Camera(Camera):
         self.uf_callback = uf_callback
         self.sample_mode = 'live'
 
+        if self.acq_worker is not None:
+            self.acq_worker.running = True
+            self.acq_worker.start()
+
         nRet = ueye.is_CaptureVideo(self.hCam, ueye.IS_DONT_WAIT)
         if nRet != ueye.IS_SUCCESS:
             raise SystemError("is_CaptureVideo ERROR")
@@ -253,8 +454,6 @@ class UC480_Camera(Camera):
         if self.sample_mode == 'still':
             self.timer.stop()
 
-        self.current_exposure_index = exp_ndx
-        self.current_ifi_index = ifi_ndx
         ep = self.exp_param[exp_ndx]
 
         # with software trigger, synchronizes the exposure to begin after calls to
@@ -262,7 +461,8 @@ class UC480_Camera(Camera):
 
         if ifi_ndx == 0:
 
-            fps_c, new_fps_c = DOUBLE(ep[0]), DOUBLE(0)
+            # a smaller readout can run faster, up to back-to-back exposures; the driver limits it to what it can do
+            fps_c, new_fps_c = DOUBLE(min(ep[0] * self.readout_speedup, 1000. / ep[1])), DOUBLE(0)
             nRet = ueye.is_SetFrameRate(self.hCam, fps_c, new_fps_c)
             if nRet != ueye.IS_SUCCESS:
                 raise SystemError("is_SetFrameRate ERROR")
@@ -273,15 +473,34 @@ class UC480_Camera(Camera):
             if nRet != ueye.IS_SUCCESS:
                 raise SystemError("is_SetExternalTrigger ERROR")
 
-            cParam = DOUBLE(ep[1])
-            nRet = ueye.is_Exposure(self.hCam, ueye.IS_EXPOSURE_CMD_SET_EXPOSURE, cParam, UINT(sizeof(DOUBLE)))
+        else:
+            nRet = ueye.is_SetExternalTrigger(self.hCam, ueye.IS_SET_TRIGGER_SOFTWARE)
             if nRet != ueye.IS_SUCCESS:
-                raise SystemError("is_Exposure ERROR")
+                raise SystemError("is_SetExternalTrigger ERROR")
+            self.actual_frame_rate = 1000./self.ifi_settings[ifi_ndx]
 
-            cam_exp = cParam.value  # Set command returns actual
-            self.actual_exposure_time_ms = cam_exp * ep[2]
+        #cam_exp = self.api.set_exposure(ep[1])
+
+        cParam = DOUBLE(ep[1])
+        nRet = ueye.is_Exposure(self.hCam, ueye.IS_EXPOSURE_CMD_SET_EXPOSURE, cParam, UINT(sizeof(DOUBLE)))
+        if nRet != ueye.IS_SUCCESS:
+            raise SystemError("is_Exposure ERROR")
+
+        cam_exp = cParam.value  # Set command returns actual
 
+        """
+        Switch exposure, pixel depth and summation state in one go, so the acquisition thread can't sum a frame
+        across two exposures or stamp it with the other exposure's depth.
+        """
+        with self.acq_lock:
+            self.current_exposure_index = exp_ndx
+            self.current_ifi_index = ifi_ndx
+            self._set_sum_depth(ep[2])
+            self.actual_exposure_time_ms = cam_exp * ep[2]
+            self.frame_ptr = 0
+            self.seq_next = None    # driver may restart the sequence
 
+        if ifi_ndx == 0:
             if self.sample_mode != 'off':
                 self.sample_mode = 'live'
                 nRet = ueye.is_CaptureVideo(self.hCam, ueye.IS_DONT_WAIT)
@@ -289,20 +508,6 @@ class UC480_Camera(Camera):
                     raise SystemError("is_CaptureVideo ERROR")
 
         else:
-            nRet = ueye.is_SetExternalTrigger(self.hCam, ueye.IS_SET_TRIGGER_SOFTWARE)
-            if nRet != ueye.IS_SUCCESS:
-                raise SystemError("is_SetExternalTrigger ERROR")
-            self.actual_frame_rate = 1000./self.ifi_settings[ifi_ndx]
-
-            #cam_exp = self.api.set_exposure(ep[1])
-
-            cParam = DOUBLE(ep[1])
-            nRet = ueye.is_Exposure(self.hCam, ueye.IS_EXPOSURE_CMD_SET_EXPOSURE, cParam, UINT(sizeof(DOUBLE)))
-            if nRet != ueye.IS_SUCCESS:
-                raise SystemError("is_Exposure ERROR")
-
-            cam_exp = cParam.value
-            self.actual_exposure_time_ms = cam_exp * ep[2]
             self.sample_mode = 'still'
             nRet = ueye.is_FreezeVideo(self.hCam, ueye.IS_DONT_WAIT)
             if nRet != ueye.IS_SUCCESS:
@@ -310,12 +515,20 @@ class UC480_Camera(Camera):
 
             self.timer.start(self.ifi_settings[ifi_ndx])
 
-        self.frame_ptr = 0
-
         #print('returned exposure time:', cam_exp)
         #et, etmin, etmax, etinc = uu.get_exposure_settings(self.hCam)
         #print('ET: ', et, etmin, etmax, etinc)
 
+    def _set_sum_depth(self, navg):
+        """
+        Set pixel_bits for an exposure summing navg frames: the sensor depth plus enough bits for the sum, up to
+        SUM_MAX_BITS.  Sums that need more are shifted down (sum_shift) to fit.
+        """
+        sum_bits = UC480_PIXEL_BITS + int(np.ceil(np.log2(navg)))
+        self.pixel_bits = min(sum_bits, SUM_MAX_BITS)
+        self.pixel_maxval = 2**self.pixel_bits
+        self.sum_shift = sum_bits - self.pixel_bits
+
     def led_state(self, state):
         """
 
@@ -373,14 +586,33 @@ class UC480_Camera(Camera):
             self.timer.stop()
         self.sample_mode = 'off'
 
+        if self.acq_worker is not None:
+            self.acq_worker.stop()
+
+        if self.seq_mem or self.acq_thread:
+            print('Image buffers: %s' % self.buffer_stats())
+
     def release(self):
-        nRet = uu.is_EnableMessage(self.hCam, ueye.IS_FRAME, 0)
-        if nRet != ueye.IS_SUCCESS:
-            raise SystemError("is_Enable(disable)Message ERROR")
+        if self.acq_thread:
+            nRet = ueye.is_DisableEvent(self.hCam, ueye.IS_SET_EVENT_FRAME)
+            if nRet != ueye.IS_SUCCESS:
+                raise SystemError("is_DisableEvent ERROR")
+            nRet = ueye.is_ExitEvent(self.hCam, ueye.IS_SET_EVENT_FRAME)
+            if nRet != ueye.IS_SUCCESS:
+                raise SystemError("is_ExitEvent ERROR")
+            windll.kernel32.CloseHandle(self.frame_event)
+            self.frame_event = None
+        else:
+            nRet = uu.is_EnableMessage(self.hCam, ueye.IS_FRAME, 0)
+            if nRet != ueye.IS_SUCCESS:
+                raise SystemError("is_Enable(disable)Message ERROR")
 
-        nRet = ueye.is_FreeImageMem(self.hCam, self.pcImageMemory, self.MemID)
-        if nRet != ueye.IS_SUCCESS:
-            raise SystemError("is_FreeImageMem ERROR")
+        if self.seq_mem:
+            self._seq_free()
+        else:
+            nRet = ueye.is_FreeImageMem(self.hCam, self.pcImageMemory, self.MemID)
+            if nRet != ueye.IS_SUCCESS:
+                raise SystemError("is_FreeImageMem ERROR")
 
         nRet = ueye.is_ExitCamera(self.hCam)
         if nRet != ueye.IS_SUCCESS:
@@ -397,67 +629,258 @@ class UC480_Camera(Camera):
         """
 
 
-        dest = self.frame[self.frame_ptr]
+        frame = self._read_frame()
+        if frame is not None:
+            self._emit_frame(frame)
+
+    def _read_frame(self):
+        """
+        Read the new image from the driver.  Single-frame exposures are copied straight into a pooled frame,
+        multi-frame exposures are added into the int32 summation buffer and the sum is returned, at pixel_bits
+        depth, when complete.
 
-        nRet = ueye.is_CopyImageMem(self.hCam, self.pcImageMemory, self.MemID, dest.ctypes.data_as(c_char_p))
+        Returns
+        -------
+        frame : Frame or None
+            completed frame (owned by the caller), None while a multi-frame exposure is incomplete.
+        """
+        max_frame = self.exp_param[self.current_exposure_index][2]
+        if max_frame == 1:  # no need to sum and clip if only one (most often)
+            frame = self._new_frame()
+            self._copy_image(frame.data)
+            return frame
+
+        self._copy_image(self.sum_image)
+        if self.frame_ptr == 0:
+            self.sum_acc[...] = self.sum_image
+        else:
+            self.sum_acc += self.sum_image
+        self.frame_ptr += 1
+        if self.frame_ptr < max_frame:
+            return None
+
+        self.frame_ptr = 0
+        frame = self._new_frame()
+        if self.sum_shift:
+            np.right_shift(self.sum_acc, self.sum_shift, out=self.sum_acc)
+        np.copyto(frame.data, self.sum_acc, casting='unsafe')   # fits: at most SUM_MAX_BITS bits
+        return frame
+
+    def _copy_image(self, dest):
+        """
+        Copy the driver's image memory into a host frame buffer.  With a capture sequence, buffers are read in
+        order, each locked while it's copied so the driver skips it.
+        """
+        if not self.seq_mem:
+            nRet = ueye.is_CopyImageMem(self.hCam, self.pcImageMemory, self.MemID, dest.ctypes.data_as(c_char_p))
+            if nRet != ueye.IS_SUCCESS:
+                raise SystemError("is_CopyImageMem ERROR")
+            return
+
+        n = len(self.seq_mem)
+        last = self._seq_last()
+        last_num = self._seq_frame_number(last)
+        if self.seq_next is None:
+            self.seq_next = last
+            self.seq_read = last_num - 1
+        fill = last_num - self.seq_read
+        if fill > n:    # overrun: the oldest unread buffers were overwritten, resume from the oldest left
+            self.seq_next = (last + 1) % n
+            fill = n
+
+        st = self.seq_stats
+        st['frames'] += 1
+        st['fill'] = fill
+        st['max_fill'] = max(st['max_fill'], fill)
+        if fill == n:
+            st['full'] += 1
+
+        mem, mid, addr = self.seq_mem[self.seq_next]
+        nRet = ueye.is_LockSeqBuf(self.hCam, ueye.IS_IGNORE_PARAMETER, mem)
+        if nRet != ueye.IS_SUCCESS:
+            raise SystemError("is_LockSeqBuf ERROR")
+
+        nRet = ueye.is_CopyImageMem(self.hCam, mem, mid, dest.ctypes.data_as(c_char_p))
         if nRet != ueye.IS_SUCCESS:
             raise SystemError("is_CopyImageMem ERROR")
+        self.seq_read = self._seq_frame_number(self.seq_next)
 
-        self.frame_ptr += 1
-        max_frame = self.exp_param[self.current_exposure_index][2]
-        if self.frame_ptr >= max_frame:
-            self.frame_ptr = 0
-            if max_frame == 1:
-                f = self.frame[0, :, :] # no need to sum and clip if only one (most often)
-            else:
-                f = np.clip(np.sum(self.frame[0:max_frame, :, :], axis=0, dtype=np.int16), 0, self.pixel_maxval)
-            #self.uf_callback(f[::2,128:-128:2])
-            self.uf_callback(f)
+        nRet = ueye.is_UnlockSeqBuf(self.hCam, ueye.IS_IGNORE_PARAMETER, mem)
+        if nRet != ueye.IS_SUCCESS:
+            raise SystemError("is_UnlockSeqBuf ERROR")
+
+        self.seq_next = (self.seq_next + 1) % n
+
+    def _seq_alloc(self, n):
+        """
+        Allocate n image memories and register them as the driver's capture sequence.
+
+        Returns
+        -------
+        ok : bool
+            False if the driver refused; anything allocated has been freed again.
+        """
+        for i in range(n):
+            mem, mid = ueye.c_mem_p(), ueye.int()
+            nRet = ueye.is_AllocImageMem(self.hCam, self.frame_shape[1], self.frame_shape[0], FRAME_BITS_PER_PIXEL,
+                                         mem, mid)
+            if nRet != ueye.IS_SUCCESS:
+                break
+            self.seq_mem.append((mem, mid, cast(mem, c_void_p).value))
+            nRet = ueye.is_AddToSequence(self.hCam, mem, mid)
+            if nRet != ueye.IS_SUCCESS:
+                break
+        else:
+            return True
 
+        self._seq_free()
+        return False
+
+    def _seq_free(self):
+        ueye.is_ClearSequence(self.hCam)
+        for mem, mid, addr in self.seq_mem:
+            ueye.is_FreeImageMem(self.hCam, mem, mid)
+        self.seq_mem = []
+
+    def _seq_last(self):
+        """
+        Index of the sequence buffer most recently completed by the driver.
+        """
+        num, mem, mem_last = INT(), ueye.c_mem_p(), ueye.c_mem_p()
+        nRet = ueye.is_GetActSeqBuf(self.hCam, num, mem, mem_last)
+        if nRet != ueye.IS_SUCCESS:
+            raise SystemError("is_GetActSeqBuf ERROR")
+
+        addr = cast(mem_last, c_void_p).value
+        for i, m in enumerate(self.seq_mem):
+            if m[2] == addr:
+                return i
+        return 0
+
+    def _seq_frame_number(self, i):
+        """
+        Driver frame number of the image in sequence buffer i.
+        """
+        info = ueye.UEYEIMAGEINFO()
+        nRet = ueye.is_GetImageInfo(self.hCam, self.seq_mem[i][1], info, sizeof(info))
+        if nRet != ueye.IS_SUCCESS:
+            raise SystemError("is_GetImageInfo ERROR")
+        return int(info.u64FrameNumber)
+
+    def seq_pending(self):
+        """
+        Number of completed sequence buffers not yet read (0 when not using a sequence), up to all of them when the
+        ring is full.  Takes acq_lock, as set_exposure resets the read position.
+        """
+        with self.acq_lock:
+            if not self.seq_mem or self.seq_next is None:
+                return 0
+            pending = self._seq_frame_number(self._seq_last()) - self.seq_read
+        return min(max(pending, 0), len(self.seq_mem))
+
+    def buffer_stats(self):
+        """
+        Summary of sequence buffer use: frames read, current and maximum fill, and how often the sequence was full
+        (i.e. the driver had to skip or overwrite a buffer).  In threaded acquisition, also the frames dropped
+        because the GUI fell behind.
+        """
+        st = self.seq_stats
+        stats = '%d frames, fill %d/%d (max %d), full %d' % (st['frames'], st['fill'], len(self.seq_mem),
+                                                             st['max_fill'], st['full'])
+        if self.acq_thread:
+            stats += ', dropped %d' % self.acq_dropped
+        return stats
+
+    def _acquire(self):
+        """
+        Acquisition-thread counterpart of _update_image.
+
+        Returns
+        -------
+        frame : Frame or None
+            completed frame, None if incomplete or dropped because the GUI is too far behind.
+        """
+        with self.acq_lock:
+            frame = self._read_frame()
+        if frame is None:
+            return None
+
+        if not self.acq_free.acquire(blocking=False):
+            self.acq_dropped += 1
+            frame.release()
+            return None
+
+        return frame
+
+    def _deliver(self, frame):
+        """
+        GUI-thread slot for frames completed by the acquisition thread.
+        """
+        try:
+            if self.sample_mode != 'off':
+                self.uf_callback(frame)
+        finally:
+            frame.release()
+            self.acq_free.release()
 
 
 class Pseudo_Camera(Camera):
     """
-    A pseudo camera to generate images squences for testing.
+    A pseudo camera to generate images squences for testing.  Frames come from a synthetic scene (see synthetic.py),
+    dark during calibrations.
     """
 
-    def __init__(self):
+    def __init__(self, fps=0., seed=0):
+        """
+
+        Parameters
+        ----------
+        fps : float
+            frame rate, regardless of exposure (the exposure only sets the brightness).  0 for a frame every
+            exposure time (or inter-frame interval), like a real camera.
+        seed : int
+            scene and noise seed
+        """
         super().__init__()
         self.dev_list = [(0, 'Pseudo', 'S/N')]
         self.uses_timer = True
+        self.fps = fps
+        self.pixel_bits = UC480_PIXEL_BITS
+        self.pixel_maxval = 2**self.pixel_bits
+        self.scene = SyntheticScene(self.frame_shape, self.pixel_bits, seed)
+
+    def _interval_ms(self):
+        if self.current_ifi_index != 0:
+            return self.ifi_settings[self.current_ifi_index]
+        if self.fps > 0:
+            return int(round(1000. / self.fps))
+        return self.exposure_settings[self.current_exposure_index]
 
     def start_sampling(self, uf_callback):
         self.uf_callback = uf_callback
 
         self.timer = QtCore.QTimer()
+        self.timer.setTimerType(QtCore.Qt.PreciseTimer)
         self.timer.timeout.connect(self.__tick_callback)
-        self.timer.start(self.exposure_settings[self.current_exposure_index])
+        self.timer.start(self._interval_ms())
 
     def set_exposure(self, exp_ndx, ifi_ndx):
         self.current_exposure_index = exp_ndx
         self.current_ifi_index = ifi_ndx
         if self.timer is not None:
-            if ifi_ndx == 0:
-                self.timer.setInterval(self.exposure_settings[exp_ndx])
-            else:
-                self.timer.setInterval(self.ifi_settings[ifi_ndx])
-            #self.timer.setInterval(self.exposure_settings[exp_ndx])
+            self.timer.setInterval(self._interval_ms())
         self.actual_exposure_time_ms = self.exposure_settings[exp_ndx]
+        self.actual_frame_rate = 1000. / max(self._interval_ms(), 1)
 
     def __tick_callback(self):
         """
-        timer-driven call-back.
+        timer-driven call-back.  Scene time follows the frame count, so a run is repeatable for a given seed.
         """
-        if self.cal_active:
-            si = np.empty((FRAME_HEIGHT, FRAME_WIDTH), dtype=np.int16)
-            si.fill(10)
-        else:
-            s = np.random.normal(128., 10., (FRAME_HEIGHT, FRAME_WIDTH))
-            si = s.astype(np.int16)
-            si[100:160, 100:160] -= 50
-            si[600:680, 700:800] += 50
+        frame = self._new_frame()
+        t_s = frame.seq / self.actual_frame_rate
+        self.scene.frame(frame.data, self.actual_exposure_time_ms, frame.seq, t_s, dark=self.cal_active)
 
-        self.uf_callback(si)
+        self._emit_frame(frame)
 
 
 class Web_Camera(Camera):
@@ -465,6 +888,7 @@ class Web_Camera(Camera):
         super().__init__()
         self.dev_list = [(0, 'web', 'S/N')]
         self.uses_timer = True
+        self.pool = FramePool((FRAME_HEIGHT, FRAME_WIDTH), np.uint16)
 
     def connect(self, win_id):
         self.api = cv2.VideoCapture(self.dev_list[0][0])
@@ -501,11 +925,12 @@ class Web_Camera(Camera):
         rval, frame = self.api.read()
         f = np.sum(frame, axis=2, dtype=np.uint16) // 3
         h, w = f.shape
-        fbig = np.ndarray((1024, 1280), np.uint16)
+        big = self._new_frame()
+        fbig = big.data
         fbig.fill(128 * 3)
         fbig[0:h, 0:w] = f
         fbig[1024 - h:, 1280 - w:] = f[::-1, ::-1]
-        self.uf_callback(fbig)
+        self._emit_frame(big)
 
     def stop_sampling(self):
         pass
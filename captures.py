@@ -0,0 +1,248 @@
+"""
+Capture persistence and caching.
+
+Captures are written to TIFF by a small thread pool so that saving, particularly to network-mapped capture
+directories, never stalls the live view.  The captured frames themselves are kept by a CaptureStore so the palette
+doesn't have to read them back from disk.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import PIL.Image
+from PyQt5 import QtCore
+
+CAPTURE_WRITER_THREADS = 1  # one thread keeps files written in capture order
+THUMBNAIL_STEP = 4          # palette shows every 4th pixel in each direction
+
+
+def write_capture(fn, data, pixel_bits):
+    """
+    Write a frame as a 16-bit gray-scale TIFF, left-justifying the camera's pixel_bits.
+
+    Note that despite lack of documenation, PIL does save this as 16-bit gray-scale image.  Open in Photoshop to
+    confirm. Irfan converts to 8 bpp upon opening ans scales pixels
+
+    Parameters
+    ----------
+    fn : str
+        file path
+    data : ndarray
+        frame pixel data
+    pixel_bits : int
+        camera pixel depth
+    """
+    image = data.astype(np.uint16)
+    np.left_shift(image, 16 - pixel_bits, out=image)
+    PIL.Image.fromarray(image).save(fn, 'TIFF')
+
+
+def read_capture(fn, pixel_bits):
+    """
+    Read a capture back from its TIFF.  Touches nothing but the file, so it's safe on any thread.
+
+    Parameters
+    ----------
+    fn : str
+        file path
+    pixel_bits : int
+        pixel depth the capture was written at
+
+    Returns
+    -------
+    data : ndarray or None
+        pixel data at the capture's depth, None if the file can't be read.
+    """
+    try:
+        data = np.array(PIL.Image.open(fn))
+    except OSError:
+        return None
+    return (data >> (16 - pixel_bits)).astype(np.uint16)
+
+
+class CaptureWriter(QtCore.QObject):
+    """
+    Background TIFF writer for captures.
+
+    ``write`` takes over a reference to the frame and returns immediately.  When the file has been written (or the
+    write failed) ``done`` is emitted with the frame, the file name and an error string (empty on success).  Connect it
+    to a slot on the GUI thread, which must release the frame.
+    """
+    done = QtCore.pyqtSignal(object, str, str)
+
+    def __init__(self, threads=CAPTURE_WRITER_THREADS):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = 0        # captures queued and not yet written
+        self.pending_lock = threading.Lock()
+
+    def write(self, fn, frame, pixel_bits):
+        """
+        Queue a capture for writing.
+
+        Parameters
+        ----------
+        fn : str
+            file path
+        frame : Frame
+            frame to write.  The caller's reference is handed back with the ``done`` signal.
+        pixel_bits : int
+            camera pixel depth
+        """
+        with self.pending_lock:
+            self.pending += 1
+        self.executor.submit(self._write, fn, frame, pixel_bits)
+
+    def _write(self, fn, frame, pixel_bits):
+        """
+        Any failure is reported with ``done``, which is always emitted so the frame is released.
+        """
+        err = ''
+        try:
+            write_capture(fn, frame.data, pixel_bits)
+        except Exception as e:
+            err = str(e) or type(e).__name__
+        finally:
+            with self.pending_lock:
+                self.pending -= 1
+            self.done.emit(frame, fn, err)
+
+    def shutdown(self):
+        """
+        Finish any queued writes.
+        """
+        if self.pending:
+            print('Finishing %d capture write(s)' % self.pending)
+        self.executor.shutdown(wait=True)
+
+
+class CaptureStore(object):
+    """
+    In-memory store of the session's captures, indexed by capture number (1..n).
+
+    A 1/THUMBNAIL_STEP thumbnail is kept for every capture so scrolling through the palette never touches the disk.
+    Full-resolution frames (needed when the live screen shows a capture) are held in an LRU cache bounded by a memory
+    budget.  On a miss the frame is read back from its file with ``read_capture``, and the neighbours of the requested
+    capture are read ahead on a background thread.
+
+    All methods are called from the GUI thread; the read-ahead thread only runs ``read_capture``, with the file name
+    and pixel depth recorded when the capture was added.
+    """
+
+    def __init__(self, budget_mb):
+        """
+
+        Parameters
+        ----------
+        budget_mb : int
+            memory budget for full-resolution frames, in MB
+        """
+        self.budget = budget_mb * 2**20
+        self.files = {}                     # ndx -> (file name, pixel_bits)
+        self.thumbs = {}
+        self.full_frames = OrderedDict()    # ndx -> (Frame or None, data), most recently used last
+        self.nbytes = 0
+        self.unwritten = {}                 # Frame -> ndx, not evicted until the writer has finished
+        self.loading = {}                   # ndx -> Future of read-ahead
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def add(self, ndx, frame, fn):
+        """
+        Add a new capture, taking over the caller's reference to the frame.  fn is the file it's being written to.
+        """
+        self.files[ndx] = (fn, frame.pixel_bits)
+        self.thumbs[ndx] = np.ascontiguousarray(frame.data[::THUMBNAIL_STEP, ::THUMBNAIL_STEP])
+        self.unwritten[frame] = ndx
+        self._insert(ndx, frame, frame.data)
+
+    def written(self, frame):
+        """
+        Notify that the capture writer has finished with a frame, so it may be evicted.
+        """
+        self.unwritten.pop(frame, None)
+        self._evict()
+
+    def thumbnail(self, ndx):
+        """
+        Return the thumbnail of capture ndx, None if it's not available.
+        """
+        if ndx not in self.thumbs:
+            data = self.full(ndx)
+            if data is None:
+                return None
+            self.thumbs[ndx] = np.ascontiguousarray(data[::THUMBNAIL_STEP, ::THUMBNAIL_STEP])
+        return self.thumbs[ndx]
+
+    def full(self, ndx):
+        """
+        Return the full-resolution pixel data of capture ndx, None if it's not available.
+        """
+        self._harvest()
+        if ndx in self.full_frames:
+            self.full_frames.move_to_end(ndx)
+            data = self.full_frames[ndx][1]
+        else:
+            future = self.loading.pop(ndx, None)
+            data = future.result() if future is not None else self._load(ndx)
+            if data is None:
+                return None
+            self._insert(ndx, None, data)
+
+        self._prefetch(ndx)
+        return data
+
+    def clear(self):
+        for frame, data in self.full_frames.values():
+            if frame is not None:
+                frame.release()
+        self.full_frames.clear()
+        self.files.clear()
+        self.thumbs.clear()
+        self.unwritten.clear()
+        self.loading.clear()
+        self.nbytes = 0
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def _load(self, ndx):
+        if ndx not in self.files:
+            return None
+        return read_capture(*self.files[ndx])
+
+    def _insert(self, ndx, frame, data):
+        self.full_frames[ndx] = (frame, data)
+        self.nbytes += data.nbytes
+        self._evict()
+
+    def _evict(self):
+        """
+        Drop least recently used frames until within budget.  The most recent entry is always kept.
+        """
+        for ndx in list(self.full_frames.keys())[:-1]:
+            if self.nbytes <= self.budget:
+                break
+            frame, data = self.full_frames[ndx]
+            if frame in self.unwritten:
+                continue
+            del self.full_frames[ndx]
+            self.nbytes -= data.nbytes
+            if frame is not None:
+                frame.release()
+
+    def _prefetch(self, ndx):
+        for n in (ndx - 1, ndx + 1):
+            if n in self.files and n not in self.full_frames and n not in self.loading:
+                self.loading[n] = self.executor.submit(read_capture, *self.files[n])
+
+    def _harvest(self):
+        """
+        Move completed read-aheads into the cache.
+        """
+        for n, future in list(self.loading.items()):
+            if future.done():
+                del self.loading[n]
+                data = future.result()
+                if data is not None and n not in self.full_frames:
+                    self._insert(n, None, data)
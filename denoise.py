@@ -0,0 +1,143 @@
+"""
+Live temporal denoise.
+
+FrameAverager averages the live stream over the last N frames (boxcar) or with an exponential moving average.  All
+buffers are allocated once, and each frame costs a fixed handful of full-frame operations whatever N is:
+
+    boxcar  the last N frames are kept in a ring alongside their int32 sum; the new frame replaces the oldest in both.
+    ema     a float32 average moves a fraction 2 / (N + 1) of the way to each new frame (about the noise of an
+            N-frame boxcar, with a longer tail).
+
+The average is restarted when the exposure or the frame shape changes.
+"""
+import numpy as np
+
+from frames import FramePool
+
+DENOISE_MODES = ('off', 'boxcar', 'ema')
+
+
+def parse_denoise(setting):
+    """
+    Parse a Denoise option such as ``off``, ``boxcar 4`` or ``ema 8``.
+
+    Returns
+    -------
+    mode, n : str, int
+        n is 1 for off
+
+    Raises
+    ------
+    ValueError
+        unknown mode or bad frame count
+    """
+    words = setting.lower().split()
+    if not words or words[0] not in DENOISE_MODES:
+        raise ValueError('unknown denoise mode <%s>' % setting)
+    if words[0] == 'off':
+        return 'off', 1
+    n = int(words[1]) if len(words) > 1 else 4
+    if n < 1:
+        raise ValueError('denoise needs at least 1 frame <%s>' % setting)
+    return words[0], n
+
+
+class FrameAverager(object):
+    """
+    Running average of a frame stream, as pooled Frames of the input's shape and dtype.
+    """
+
+    def __init__(self, mode='off', n=1):
+        self.mode = 'off'
+        self.n = 1
+        self.pool = None
+        self.ring = None        # boxcar: last n frames
+        self.acc = None         # boxcar: int32 sum of the ring, ema: float32 average
+        self.scratch = None     # int32 (boxcar) or float32 (ema), same shape
+        self.count = 0          # frames in the average so far
+        self.pos = 0            # ring slot of the oldest frame
+        self.exposure_ms = None
+        self.set_mode(mode, n)
+
+    @property
+    def active(self):
+        return self.mode != 'off' and self.n > 1
+
+    def set_mode(self, mode, n):
+        if mode not in DENOISE_MODES:
+            raise ValueError('unknown denoise mode <%s>' % mode)
+        self.mode = mode
+        self.n = n
+        self.pool = None        # reallocate on the next frame
+        self.ring = None
+        self.acc = None
+        self.scratch = None
+
+    def reset(self):
+        self.count = 0
+        self.pos = 0
+
+    def _allocate(self, data):
+        self.pool = FramePool(data.shape, data.dtype)
+        if self.mode == 'boxcar':
+            self.ring = np.empty((self.n,) + data.shape, data.dtype)
+            self.acc = np.zeros(data.shape, np.int32)
+            self.scratch = np.empty(data.shape, np.int32)
+        else:
+            self.ring = None
+            self.acc = np.zeros(data.shape, np.float32)
+            self.scratch = np.empty(data.shape, np.float32)
+        self.reset()
+
+    def apply(self, frame):
+        """
+        Add a frame and return the current average.
+
+        Parameters
+        ----------
+        frame : Frame
+            left unchanged
+
+        Returns
+        -------
+        avg : Frame
+            new reference, owned by the caller, with the input's metadata
+        """
+        data = frame.data
+        if self.pool is None or self.pool.shape != data.shape or self.pool.dtype != data.dtype:
+            self._allocate(data)
+        if frame.exposure_ms != self.exposure_ms:
+            self.exposure_ms = frame.exposure_ms
+            self.reset()
+
+        avg = self.pool.get(like=frame)
+
+        if self.mode == 'boxcar':
+            if self.count < self.n:
+                self.count += 1
+                if self.count == 1:
+                    self.acc[...] = data
+                else:
+                    self.acc += data
+                self.ring[self.count - 1] = data
+            else:
+                oldest = self.ring[self.pos]
+                self.acc -= oldest
+                oldest[...] = data
+                self.acc += data
+                self.pos = (self.pos + 1) % self.n
+            np.add(self.acc, self.count // 2, out=self.scratch)
+            np.floor_divide(self.scratch, self.count, out=self.scratch)
+        else:
+            if self.count == 0:
+                self.acc[...] = data
+            else:
+                alpha = 2. / (self.n + 1)
+                np.subtract(data, self.acc, out=self.scratch)
+                self.scratch *= alpha
+                self.acc += self.scratch
+            self.count += 1
+            np.rint(self.acc, out=self.scratch)
+
+        avg.data[...] = self.scratch
+        return avg
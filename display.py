@@ -0,0 +1,156 @@
+"""
+Mapping of camera frames to 8-bit display images.
+
+The intensity window (``DispParam.iwindow``, percent of the camera's pixel_maxval) is folded into a uint8 look-up
+table once per window change.  Each frame is then mapped with a single indexed gather into a reused output buffer,
+replacing the per-frame float conversion, scaling and clipping.  np.take converts non-intp indices to a temporary
+intp array, so the frame is first clipped into a reused intp buffer; nothing is allocated per frame.
+
+DisplayScheduler decides which frames are actually rendered, so the display runs at most at a set rate however fast
+the camera is.
+"""
+import time
+from collections import deque
+
+import numpy as np
+from PyQt5 import QtCore
+
+RENDER_FPS_AVERAGES = 10    # renders in the rendered-fps estimate
+
+
+class DisplayLut(object):
+    """
+    Intensity-window look-up table with a one-entry cache.
+
+    The table has ``pixel_maxval + 1`` entries and is rebuilt only when the window or the camera's pixel_maxval (i.e.
+    pixel_bits) changes.  Levels outside the table, e.g. negative values or web-cam sums above pixel_maxval, are
+    clipped to the end entries which is what the float path used to do.
+    """
+
+    def __init__(self):
+        self.lut = None
+        self.key = None
+        self.gray = {}      # output buffers, keyed by frame shape
+        self.index = {}     # intp index buffers, keyed by frame shape
+
+    def table(self, iwin, maxval):
+        """
+        Return the look-up table for a window, rebuilding it only if the window or maxval changed.
+
+        Parameters
+        ----------
+        iwin : [float, float]
+            intensity window (min, max) in percent of maxval
+        maxval : int
+            camera pixel_maxval
+
+        Returns
+        -------
+        lut : ndarray (uint8)
+        """
+        key = (float(iwin[0]), float(iwin[1]), maxval)
+        if key != self.key:
+            smin, smax = iwin[0]/100., iwin[1]/100.
+            levels = np.arange(maxval + 1, dtype=np.float64) / maxval
+            levels -= smin
+            levels *= 255. / (smax - smin)
+            self.lut = np.clip(levels, 0., 255.).astype(np.uint8)
+            self.key = key
+
+        return self.lut
+
+    def apply(self, frame, iwin, maxval):
+        """
+        Map a frame (or a strided view of one) through the window.
+
+        Note that the returned array is an internal buffer that is overwritten by the next call with the same frame
+        shape.  Copy it if it has to outlive the current frame.
+
+        Parameters
+        ----------
+        frame : ndarray (integer)
+        iwin : [float, float]
+            intensity window (min, max) in percent of maxval
+        maxval : int
+            camera pixel_maxval
+
+        Returns
+        -------
+        gray : ndarray (uint8, C-contiguous)
+        """
+        lut = self.table(iwin, maxval)
+        gray = self.gray.get(frame.shape)
+        if gray is None:
+            gray = np.empty(frame.shape, dtype=np.uint8)
+            self.gray[frame.shape] = gray
+            self.index[frame.shape] = np.empty(frame.shape, dtype=np.intp)
+        index = self.index[frame.shape]
+
+        np.clip(frame, 0, maxval, out=index)
+        np.take(lut, index, out=gray)
+        return gray
+
+
+class DisplayScheduler(QtCore.QObject):
+    """
+    Coalesces frames for display.
+
+    The viewer calls ``frame_arrived`` for every frame (after any processing that must see every frame, e.g.
+    calibration and recording).  The render function is called at most ``max_fps`` times a second; a frame arriving
+    early is not rendered right away but a render of the latest frame is scheduled for when the interval is up, so
+    the last frame of a burst is always shown.  Nothing is rendered while the display is hidden.
+    """
+
+    def __init__(self, render, max_fps, parent=None):
+        """
+
+        Parameters
+        ----------
+        render : callable
+            renders the latest frame, no arguments
+        max_fps : float
+            most renders per second, 0 for no limit
+        parent : QObject
+        """
+        super().__init__(parent)
+        self.render = render
+        self.interval = 1. / max_fps if max_fps > 0 else 0.
+        self.last = 0.
+        self.render_times = deque(maxlen=RENDER_FPS_AVERAGES)
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self._render)
+
+    def frame_arrived(self, visible=True):
+        """
+        A new latest frame is available.
+
+        Parameters
+        ----------
+        visible : bool
+            False if the display can't be seen (minimized, hidden): the frame isn't rendered.
+        """
+        if not visible:
+            self.timer.stop()
+            return
+
+        wait = self.last + self.interval - time.perf_counter()
+        if wait <= 0.:
+            self.timer.stop()
+            self._render()
+        elif not self.timer.isActive():
+            self.timer.start(int(wait * 1000.) + 1)
+
+    def _render(self):
+        self.last = time.perf_counter()
+        self.render_times.append(self.last)
+        self.render()
+
+    @property
+    def fps(self):
+        """
+        Rendered frames per second, recent average.
+        """
+        if len(self.render_times) < 2 or self.render_times[-1] == self.render_times[0]:
+            return 0.
+        return (len(self.render_times) - 1) / (self.render_times[-1] - self.render_times[0])
@@ -0,0 +1,120 @@
+"""
+Pooled, reference-counted frame buffers.
+
+A Frame is a numpy buffer plus acquisition metadata.  Cameras take frames from their pool, fill them and pass them to
+the frame callback; whoever wants to keep a frame beyond the callback takes a reference with ``acquire`` and gives
+it back with ``release``.  When the last reference goes the buffer returns to its pool, so in steady state no frame
+memory is allocated.
+"""
+import threading
+
+import numpy as np
+
+
+class Frame(object):
+    """
+    Frame buffer with metadata.
+
+    Attributes
+    ----------
+    data : ndarray
+        pixel buffer (owned by the pool, do not keep views of it without holding a reference)
+    exposure_ms : float
+        actual exposure time
+    timestamp : datetime
+        time the frame was read from the camera
+    seq : int
+        camera frame sequence number
+    pixel_bits : int
+        pixel depth the frame was read at (summed exposures are deeper than single frames)
+    """
+
+    def __init__(self, pool, data):
+        self.pool = pool
+        self.data = data
+        self.refs = 0
+        self.exposure_ms = 0.
+        self.timestamp = None
+        self.seq = 0
+        self.pixel_bits = 0
+
+    def acquire(self):
+        """
+        Take a reference.  Returns the frame so this can be used inline.
+        """
+        with self.pool.ref_lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        """
+        Drop a reference, returning the buffer to the pool when it's the last one.  May be called from any thread.
+        """
+        with self.pool.ref_lock:
+            self.refs -= 1
+            refs = self.refs
+        if refs == 0:
+            self.pool.put(self)
+        elif refs < 0:
+            raise SystemError('Frame released too many times')
+
+    def copy_meta(self, other):
+        self.exposure_ms = other.exposure_ms
+        self.timestamp = other.timestamp
+        self.seq = other.seq
+        self.pixel_bits = other.pixel_bits
+
+
+class FramePool(object):
+    """
+    Free list of equally shaped frame buffers.  Thread safe, so frames can be filled on an acquisition thread and
+    released on the GUI thread.
+    """
+
+    def __init__(self, shape, dtype, max_free=8):
+        """
+
+        Parameters
+        ----------
+        shape : (int, int)
+            frame shape (rows, columns)
+        dtype : numpy dtype
+        max_free : int
+            most buffers to keep on the free list.  The pool grows as needed, e.g. while captures hold frames, but
+            surplus buffers beyond this are left to the garbage collector.
+        """
+        self.shape = shape
+        self.dtype = dtype
+        self.max_free = max_free
+        self.allocated = 0      # number of buffers ever allocated, flat in steady state
+        self._free = []
+        self._lock = threading.Lock()
+        self.ref_lock = threading.Lock()    # frame reference counts
+
+    def get(self, like=None):
+        """
+        Get a frame with one reference (owned by the caller).
+
+        Parameters
+        ----------
+        like : Frame
+            if given, copy this frame's metadata
+
+        Returns
+        -------
+        frame : Frame
+        """
+        with self._lock:
+            frame = self._free.pop() if self._free else None
+        if frame is None:
+            frame = Frame(self, np.empty(self.shape, dtype=self.dtype))
+            self.allocated += 1
+        if like is not None:
+            frame.copy_meta(like)
+
+        return frame.acquire()
+
+    def put(self, frame):
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(frame)
@@ -0,0 +1,188 @@
+"""
+OpenGL backend for the main (live) screen.
+
+The frame is uploaded as a 16-bit single-channel texture and windowed to gray levels in a fragment shader, so the CPU
+does no per-pixel work and there is no QImage -> QPixmap conversion.  ROIs, arrows and titles are drawn over it with
+QPainter by the LiveOverlay mixin shared with screens.LiveScreen.  Software (Mesa) OpenGL is fine.
+
+If the shaders can't be built (e.g. no OpenGL 2 support) the widget falls back to windowing with a DisplayLut and
+drawing the image with QPainter.
+
+Selected with the LiveBackend option.
+"""
+import numpy as np
+from PyQt5 import QtCore, QtGui, QtWidgets
+try:
+    from PyQt5 import sip
+except ImportError:     # PyQt5 before 5.11
+    import sip
+from PyQt5.QtCore import Qt
+
+from display import DisplayLut
+from screens import LiveOverlay, LIVE_SCREEN_STYLE_LIVE
+
+GL_COLOR_BUFFER_BIT = 0x4000
+GL_TRIANGLE_STRIP = 0x0005
+
+BORDER_COLOR_LIVE = Qt.green
+BORDER_COLOR_STILL = Qt.red
+BORDER_WIDTH = 2
+
+VERTEX_SHADER = """
+attribute vec2 position;
+attribute vec2 texcoord;
+varying vec2 uv;
+void main() {
+    uv = texcoord;
+    gl_Position = vec4(position, 0.0, 1.0);
+}
+"""
+
+# frame texels are normalized to 0..1 of 65535, scale maps them to 0..1 of pixel_maxval
+FRAGMENT_SHADER = """
+uniform sampler2D frame;
+uniform float scale;
+uniform float lo;
+uniform float hi;
+varying vec2 uv;
+void main() {
+    float g = clamp((texture2D(frame, uv).r * scale - lo) / (hi - lo), 0.0, 1.0);
+    gl_FragColor = vec4(g, g, g, 1.0);
+}
+"""
+
+
+class GLLiveScreen(LiveOverlay, QtWidgets.QOpenGLWidget):
+    """
+    Main screen drawn with OpenGL.  The image is set with ``set_frame`` rather than setPixmap.
+    """
+
+    def __init__(self, size, *args, **kwargs):
+        """
+
+        Parameters
+        ----------
+        size : (int, int)
+            frame shape (rows, columns); the widget shows frames 1:1.
+        """
+        super().__init__(*args, **kwargs)
+
+        self.frame_size = QtCore.QSize(size[1], size[0])
+        self.setFixedSize(size[1] + 2 * BORDER_WIDTH, size[0] + 2 * BORDER_WIDTH)
+        self.border_color = BORDER_COLOR_LIVE
+
+        self.program = None
+        self.texture = None
+        self.gl_ok = False          # shaders built; if not, draw fallback_image with QPainter
+        self.iwin = (0., 1.)          # intensity window, fractions of maxval
+        self.scale = 1.
+        self.lut = DisplayLut()
+        self.fallback_image = None
+
+    def _set_frame(self, style):
+        self.border_color = BORDER_COLOR_LIVE if style == LIVE_SCREEN_STYLE_LIVE else BORDER_COLOR_STILL
+        self.update()
+
+    def image_rect(self):
+        return QtCore.QRect(QtCore.QPoint(0, 0), self.frame_size)
+
+    def initializeGL(self):
+        program = QtGui.QOpenGLShaderProgram(self)
+        if not (program.addShaderFromSourceCode(QtGui.QOpenGLShader.Vertex, VERTEX_SHADER) and
+                program.addShaderFromSourceCode(QtGui.QOpenGLShader.Fragment, FRAGMENT_SHADER) and
+                program.link()):
+            print('OpenGL live screen unavailable, drawing without shaders: %s' % program.log())
+            return
+
+        self.texture = QtGui.QOpenGLTexture(QtGui.QOpenGLTexture.Target2D)
+        self.texture.setFormat(QtGui.QOpenGLTexture.R16_UNorm)
+        self.texture.setSize(self.frame_size.width(), self.frame_size.height())
+        self.texture.setMinificationFilter(QtGui.QOpenGLTexture.Nearest)
+        self.texture.setMagnificationFilter(QtGui.QOpenGLTexture.Nearest)
+        self.texture.allocateStorage(QtGui.QOpenGLTexture.Red, QtGui.QOpenGLTexture.UInt16)
+        if not self.texture.isStorageAllocated():
+            print('OpenGL live screen unavailable, no 16-bit textures')
+            self.texture = None
+            return
+
+        self.program = program
+        self.gl_ok = True
+
+    def set_frame(self, frame, iwin, maxval):
+        """
+        Show a frame.
+
+        Parameters
+        ----------
+        frame : ndarray
+            full-size, non-negative integer frame.  It's uploaded (or windowed) before returning, so the caller can
+            reuse it.
+        iwin : [float, float]
+            intensity window (min, max) in percent of maxval
+        maxval : int
+            camera pixel_maxval
+        """
+        self.iwin = (iwin[0] / 100., iwin[1] / 100.)
+        self.scale = 65535. / maxval
+
+        if self.gl_ok:
+            data = np.ascontiguousarray(frame).view(np.uint16)     # int16 frames are >= 0 here
+            self.makeCurrent()
+            self.texture.setData(QtGui.QOpenGLTexture.Red, QtGui.QOpenGLTexture.UInt16, sip.voidptr(data.ctypes.data))
+            self.doneCurrent()
+        else:
+            gray = self.lut.apply(frame, iwin, maxval)
+            h, w = gray.shape
+            self.fallback_image = QtGui.QImage(gray.data, w, h, gray.strides[0], QtGui.QImage.Format_Grayscale8).copy()
+
+        self.update()
+
+    def paintGL(self):
+        painter = QtGui.QPainter(self)
+        x0 = (self.width() - self.frame_size.width()) // 2
+        y0 = (self.height() - self.frame_size.height()) // 2
+
+        if self.gl_ok:
+            painter.beginNativePainting()
+            f = self.context().functions()
+            f.glClearColor(0., 0., 0., 1.)
+            f.glClear(GL_COLOR_BUFFER_BIT)
+
+            """
+            Quad covering the image area (in normalized device coordinates), frame row 0 at the top.
+            """
+            w, h = float(self.width()), float(self.height())
+            left, right = 2. * x0 / w - 1., 2. * (x0 + self.frame_size.width()) / w - 1.
+            top, bottom = 1. - 2. * y0 / h, 1. - 2. * (y0 + self.frame_size.height()) / h
+            corners = [QtGui.QVector2D(left, top), QtGui.QVector2D(right, top),
+                       QtGui.QVector2D(left, bottom), QtGui.QVector2D(right, bottom)]
+            texcoords = [QtGui.QVector2D(0., 0.), QtGui.QVector2D(1., 0.),
+                         QtGui.QVector2D(0., 1.), QtGui.QVector2D(1., 1.)]
+
+            self.program.bind()
+            self.texture.bind(0)
+            self.program.setUniformValue('frame', 0)
+            self.program.setUniformValue('scale', float(self.scale))
+            self.program.setUniformValue('lo', float(self.iwin[0]))
+            self.program.setUniformValue('hi', float(max(self.iwin[1], self.iwin[0] + 1e-6)))
+            self.program.enableAttributeArray('position')
+            self.program.enableAttributeArray('texcoord')
+            self.program.setAttributeArray('position', corners)
+            self.program.setAttributeArray('texcoord', texcoords)
+            f.glDrawArrays(GL_TRIANGLE_STRIP, 0, 4)
+            self.program.disableAttributeArray('position')
+            self.program.disableAttributeArray('texcoord')
+            self.texture.release()
+            self.program.release()
+            painter.endNativePainting()
+        else:
+            painter.fillRect(self.rect(), Qt.black)
+            if self.fallback_image is not None:
+                painter.drawImage(x0, y0, self.fallback_image)
+
+        painter.setPen(QtGui.QPen(self.border_color, BORDER_WIDTH))
+        painter.setBrush(Qt.NoBrush)
+        painter.drawRect(self.rect().adjusted(1, 1, -1, -1))
+
+        self.paint_overlay(painter)
+        painter.end()
@@ -0,0 +1,136 @@
+"""
+Live frame histogram.
+
+Pixel values are shifted down to at most HIST_LEVELS integer levels and counted with np.bincount, which is exact and
+much cheaper than np.histogram with float bin edges.  The level counts are kept so the display histogram (a few
+bins) and the contrast functions can be derived from them without touching the frame again.
+
+AutoContrast picks the intensity window from percentiles of those counts (a cumulative sum over the levels, no sort
+of the frame), so a few hot or dead pixels don't set it.  In continuous mode the window follows the percentiles
+smoothly, and only moves once the smoothed window has drifted by more than a hysteresis step, so the display tracks
+slow changes without flickering.
+"""
+import numpy as np
+
+HIST_LEVELS = 1024      # most levels counted
+HIST_STEP = 4           # histogram subsamples frames [::HIST_STEP, ::HIST_STEP]
+
+AUTO_CLIP_PCT = 0.1     # percent of pixels allowed below and above the auto window
+AUTO_SMOOTHING = 0.2    # continuous mode: fraction of the way the smoothed window moves to the target each update
+AUTO_HYSTERESIS = 1.    # continuous mode: smallest window change shown, percent of pixel_maxval
+
+
+class FrameHistogram(object):
+    """
+    Histogram of the most recent frame, at ``levels`` levels spanning 0 .. pixel_maxval.
+    """
+
+    def __init__(self):
+        self.counts = None      # counts per level
+        self.levels = 0
+        self.maxval = None
+        self.shift = 0
+        self.index = None       # intp level buffer, the size of the largest (subsampled) input so far
+
+    def update(self, frame, pixel_bits, step=HIST_STEP):
+        """
+        Count a frame.
+
+        Parameters
+        ----------
+        frame : ndarray
+            integer frame (or 1-D array of pixel values), subsampled here
+        pixel_bits : int
+            camera pixel depth.  Values above 2**pixel_bits (e.g. web-cam sums) count in the top level.
+        step : int
+            subsampling step along each axis
+
+        Returns
+        -------
+        counts : ndarray
+        """
+        if self.maxval != 2**pixel_bits:
+            self.maxval = 2**pixel_bits
+            self.shift = max(0, pixel_bits - (HIST_LEVELS.bit_length() - 1))
+            self.levels = self.maxval >> self.shift
+
+        sub = frame[(slice(None, None, step),) * frame.ndim]
+        if self.index is None or self.index.size < sub.size:
+            self.index = np.empty(sub.size, np.intp)
+        index = self.index[:sub.size].reshape(sub.shape)
+        np.right_shift(sub, self.shift, out=index)
+        np.clip(index, 0, self.levels - 1, out=index)
+        self.counts = np.bincount(self.index[:sub.size], minlength=self.levels)
+
+        return self.counts
+
+    def rebinned(self, nbins):
+        """
+        Counts in nbins equal bins (nbins must divide the number of levels).
+        """
+        return self.counts.reshape(nbins, -1).sum(axis=1)
+
+    def percentiles(self, lo_pct, hi_pct):
+        """
+        Levels below which lo_pct and hi_pct percent of the pixels lie.
+
+        Returns
+        -------
+        lo, hi : float
+            in percent of pixel_maxval (lower edge of the lo level, upper edge of the hi level)
+        """
+        cum = np.cumsum(self.counts)
+        total = cum[-1]
+        lo = np.searchsorted(cum, total * lo_pct / 100., side='right')
+        hi = np.searchsorted(cum, total * hi_pct / 100., side='left')
+        lo = min(lo, self.levels - 1)
+        hi = min(max(hi, lo), self.levels - 1)
+        return 100. * lo / self.levels, 100. * (hi + 1) / self.levels
+
+
+class AutoContrast(object):
+    """
+    Intensity window from histogram percentiles, one-shot (``window``) or tracked over time (``track``).
+    """
+
+    def __init__(self, clip_pct=AUTO_CLIP_PCT, smoothing=AUTO_SMOOTHING, hysteresis=AUTO_HYSTERESIS):
+        self.clip_pct = clip_pct
+        self.smoothing = smoothing
+        self.hysteresis = hysteresis
+        self.smoothed = None    # continuous mode state
+        self.shown = None
+
+    def reset(self):
+        self.smoothed = None
+        self.shown = None
+
+    def window(self, histogram):
+        """
+        Window clipping clip_pct percent of the pixels at each end.
+
+        Returns
+        -------
+        [lo, hi] : [float, float]
+            percent of pixel_maxval
+        """
+        return list(histogram.percentiles(self.clip_pct, 100. - self.clip_pct))
+
+    def track(self, histogram):
+        """
+        Continuous mode: update the smoothed window from the latest histogram.
+
+        Returns
+        -------
+        [lo, hi] or None
+            the window to show, or None if it hasn't moved more than the hysteresis since last shown.
+        """
+        target = np.array(self.window(histogram))
+        if self.smoothed is None:
+            self.smoothed = target
+        else:
+            self.smoothed += self.smoothing * (target - self.smoothed)
+
+        if self.shown is not None and np.abs(self.smoothed - self.shown).max() < self.hysteresis:
+            return None
+        self.shown = self.smoothed.copy()
+        return list(self.shown)
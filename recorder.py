@@ -0,0 +1,159 @@
+"""
+Stack (multi-page TIFF) recording on a writer thread.
+
+The GUI only queues a reference to each frame.  Windowing, rebinning, tagging and appending the page to the TIFF all
+happen on the recorder's own thread, so a slow disk can't hold up the live display.  The page (and rebinning sum)
+buffers are allocated once for the recording, so writing a frame allocates nothing.  The queue is bounded: if the
+writer falls that far behind, frames are dropped and counted.  Pages are written with tiffstack.StackWriter.
+"""
+import queue
+import threading
+
+import numpy as np
+import doriclib
+
+from tiffstack import StackWriter
+
+RECORDER_QUEUE_SIZE = 32    # frames
+
+
+class StackRecorder(object):
+    """
+    Streams frames to a multi-page TIFF with Doric tags.
+    """
+
+    def __init__(self, fn, shape, x_window, y_window, rebin, bigtiff=False):
+        """
+
+        Parameters
+        ----------
+        fn : str
+            TIFF file path
+        shape : (int, int)
+            shape (rows, columns) of the frames to be recorded
+        x_window, y_window : int
+            size of the centred window to record
+        rebin : int
+            rebinning factor (2 = 2x2 ...), 1 for none
+        bigtiff : bool
+            write a BigTIFF, needed for stacks over 4 GB.
+        """
+        self.x_window = x_window
+        self.y_window = y_window
+        self.rebin = rebin
+
+        """
+        Centred window, trimmed to a multiple of the rebinning factor, and the buffers for the page written.
+        """
+        h, w = shape
+        x0 = max(0, (w - x_window) // 2)
+        y0 = max(0, (h - y_window) // 2)
+        wh = (h - 2 * y0) // rebin * rebin
+        ww = (w - 2 * x0) // rebin * rebin
+        self.window = (slice(y0, y0 + wh), slice(x0, x0 + ww))
+        self.page = np.empty((wh // rebin, ww // rebin), np.uint16)
+        self.bin_sum = np.empty(self.page.shape, np.int32) if rebin > 1 else None
+
+        self.accepted = 0       # frames queued
+        self.written = 0        # frames written
+        self.dropped = 0        # frames dropped because the queue was full
+        self.error = None       # first write error, nothing more is written after one
+
+        self.queue = queue.Queue(maxsize=RECORDER_QUEUE_SIZE)
+        self.ifd = doriclib.DoricImageFileDirectory(0)
+        self.tiff_out = StackWriter(fn, bigtiff)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, frame, et, ts_ms):
+        """
+        Queue a frame for writing.
+
+        Parameters
+        ----------
+        frame : Frame
+            frame to record.  A reference is taken for the writer.
+        et : int
+            exposure time tag, ms
+        ts_ms : int
+            time stamp tag, ms from start of recording
+
+        Returns
+        -------
+        queued : bool
+            False if the frame was dropped.
+        """
+        try:
+            self.queue.put_nowait((frame.acquire(), self.accepted, et, ts_ms))
+        except queue.Full:
+            frame.release()
+            self.dropped += 1
+            return False
+
+        self.accepted += 1
+        return True
+
+    def status(self):
+        """
+        Short progress string: frames written, queue depth and dropped frames.
+        """
+        return '%d  (q %d, drop %d)' % (self.written, self.queue.qsize(), self.dropped)
+
+    def close(self, wait=False):
+        """
+        Finish writing the queued frames and close the file.
+
+        Parameters
+        ----------
+        wait : bool
+            if True, block until the file is closed.
+        """
+        self.queue.put(None)
+        if wait:
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frame, num, et, ts_ms = item
+            try:
+                if self.error is None:
+                    self._write(frame.data, frame.pixel_bits, num, et, ts_ms)
+                    self.written += 1
+            except (OSError, ValueError) as e:
+                self.error = str(e)
+            finally:
+                frame.release()
+
+        self.tiff_out.close()
+
+    def _write(self, image, pixel_bits, num, et, ts_ms):
+        # MRP ToDo update these tags properly.
+        self.ifd.update_tags((num, 0), et, 0, ts_ms, 99)
+
+        """
+        Perform the TIFF windowing and then rebinning (compress) according to config file options.  Each frame is
+        left-justified from its own depth, which changes with the exposure (summed exposures are deeper), and a
+        rebinned sum too deep for 16 bits is shifted down instead.
+        """
+        image = image[self.window]
+
+        shift_bits = 16 - pixel_bits
+        if self.rebin > 1:   # not tested for r ne 2
+            r = self.rebin
+            h, w = image.shape
+            np.sum(image.reshape((h // r, r, w // r, r)), axis=(1, 3), dtype=np.int32, out=self.bin_sum)
+            extra_bits = 2 * (r.bit_length() - 1)
+            shift_bits = shift_bits - extra_bits
+            if shift_bits >= 0:
+                np.left_shift(self.bin_sum, shift_bits, out=self.bin_sum)
+            else:
+                np.right_shift(self.bin_sum, -shift_bits, out=self.bin_sum)
+            np.copyto(self.page, self.bin_sum, casting='unsafe')
+        else:
+            np.copyto(self.page, image, casting='unsafe')
+            np.left_shift(self.page, shift_bits, out=self.page)
+
+        self.tiff_out.write(self.page, self.ifd)
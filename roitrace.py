@@ -0,0 +1,140 @@
+"""
+Live ROI intensity traces.
+
+While tracing is on, every frame's mean, min, max and sum over each ROI on the live screen are appended to a
+fixed-size ring buffer for that ROI.  The statistics use the ROI's cached bounding-box mask (screens.Roi.mask), so a
+dozen ROIs cost little per frame.  Traces can be plotted (TracePlot) and written to CSV.
+"""
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import Qt
+
+TRACE_LENGTH = 8192         # samples kept per ROI
+TRACE_PLOT_POINTS = 300     # most recent samples plotted
+TRACE_COLORS = (Qt.yellow, Qt.cyan, Qt.magenta, Qt.green, Qt.red, Qt.white)
+TRACE_FIELDS = ('time_s', 'mean', 'min', 'max', 'sum')
+
+
+class TraceBuffer(object):
+    """
+    Ring buffer of trace samples, one row of TRACE_FIELDS per frame.
+    """
+
+    def __init__(self, capacity=TRACE_LENGTH):
+        self.data = np.zeros((capacity, len(TRACE_FIELDS)))
+        self.count = 0          # samples ever appended
+
+    def append(self, row):
+        self.data[self.count % len(self.data)] = row
+        self.count += 1
+
+    def ordered(self, last=None):
+        """
+        The samples held (or the last ``last`` of them), oldest first.
+        """
+        n = min(self.count, len(self.data))
+        if last is not None:
+            n = min(n, last)
+        end = self.count % len(self.data)
+        if end >= n:
+            return self.data[end - n:end]
+        return np.concatenate((self.data[len(self.data) - (n - end):], self.data[:end]))
+
+
+class RoiTraces(object):
+    """
+    Trace buffers for the ROIs, keyed by Roi.roi_id.  Buffers of deleted ROIs are kept until cleared, so they're
+    still written to CSV.
+    """
+
+    def __init__(self, capacity=TRACE_LENGTH):
+        self.capacity = capacity
+        self.buffers = OrderedDict()
+        self.t0 = None          # time of the first sample
+
+    def clear(self):
+        self.buffers.clear()
+        self.t0 = None
+
+    def update(self, frame, timestamp, rois):
+        """
+        Add a frame's statistics for each ROI.
+
+        Parameters
+        ----------
+        frame : ndarray
+        timestamp : datetime
+            frame time (now if None)
+        rois : list of Roi
+        """
+        if timestamp is None:
+            timestamp = datetime.now()
+        if self.t0 is None:
+            self.t0 = timestamp
+        t = (timestamp - self.t0).total_seconds()
+
+        for roi in rois:
+            window, mask = roi.mask(frame.shape)
+            if not mask.any():
+                continue
+            values = frame[window][mask]
+            total = values.sum(dtype=np.int64)
+            buf = self.buffers.get(roi.roi_id)
+            if buf is None:
+                buf = self.buffers[roi.roi_id] = TraceBuffer(self.capacity)
+            buf.append((t, total / len(values), values.min(), values.max(), total))
+
+    def write_csv(self, fn):
+        """
+        Write all traces, one row per ROI and sample.
+        """
+        with open(fn, 'wt') as f:
+            f.write('# ROI traces, t0 = %s\n' % (self.t0.isoformat() if self.t0 is not None else ''))
+            f.write('roi,' + ','.join(TRACE_FIELDS) + '\n')
+            for roi_id, buf in self.buffers.items():
+                for row in buf.ordered():
+                    f.write('%d,%.3f,%.3f,%d,%d,%d\n' % ((roi_id,) + tuple(row)))
+
+
+class TracePlot(QtWidgets.QWidget):
+    """
+    Mean-intensity traces of the current ROIs, drawn with QPainter on a common, auto-scaled axis.
+    """
+
+    def __init__(self, parent=None, width=320, height=100):
+        super().__init__(parent)
+        self.setFixedSize(width, height)
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+        self.traces = []        # (color, mean values)
+
+    def update_plot(self, roi_traces, rois):
+        """
+        Take the latest samples of the given ROIs' traces and schedule a repaint.
+        """
+        self.traces = []
+        for i, roi in enumerate(rois):
+            buf = roi_traces.buffers.get(roi.roi_id)
+            if buf is not None and buf.count > 1:
+                self.traces.append((TRACE_COLORS[i % len(TRACE_COLORS)], buf.ordered(TRACE_PLOT_POINTS)[:, 1]))
+        self.update()
+
+    def paintEvent(self, event):
+        qp = QtGui.QPainter(self)
+        qp.fillRect(self.rect(), Qt.black)
+
+        if self.traces:
+            lo = min(y.min() for c, y in self.traces)
+            hi = max(y.max() for c, y in self.traces)
+            span = max(hi - lo, 1.)
+            w = self.width() - 1.
+            h = self.height() - 1.
+            for color, y in self.traces:
+                x = w * np.arange(len(y)) / (TRACE_PLOT_POINTS - 1)
+                yp = h - h * (y - lo) / span
+                qp.setPen(QtGui.QPen(color, 1))
+                qp.drawPolyline(QtGui.QPolygonF([QtCore.QPointF(a, b) for a, b in zip(x, yp)]))
+
+        qp.end()
@@ -3,10 +3,11 @@ Classes and functions to support the two screens (live and capture) and associat
 
 M. Palmer, June 2016
 """
+import itertools
+
 from PyQt5 import QtCore, QtWidgets, QtGui
 from PyQt5.QtCore import Qt
 import numpy as np
-from matplotlib.path import Path
 
 LIVE_SCREEN_TAG = 'liveScreen'
 LIVE_SCREEN_STYLE_LIVE = '{ border: 2px solid green; }'
@@ -24,7 +25,7 @@ TL_SCREEN_STYLE_DORMANT = '{ border: 1px solid green; }'
 MOUSE_POS_COLOR = Qt.yellow
 MOUSE_POS_FONT = 'Courier'
 MOUSE_POS_FONTSIZE = 14
-MOUSE_POS_X = 1150
+MOUSE_POS_X = 130        # from the right edge of the image
 MOUSE_POS_Y = 20
 
 ROI_HIGHLIGHT_COLOR = Qt.red
@@ -56,6 +57,8 @@ LIVE_TITLE_Y = 20
 LIVE_TITLE_FONT = "Ariel"
 LIVE_TITLE_FONTSIZE = 14
 
+_roi_ids = itertools.count(1)
+
 class Roi(QtGui.QPolygon):
     """
     ROI class.  Basically a polygon with a few added characteristics
@@ -66,17 +69,35 @@ class Roi(QtGui.QPolygon):
         self.visible = True
         self.color = ROI_COLOR
         self.activated = False  # set to enable control point views
+        self.mask_cache = None  # (points, shape, window, mask) of the last mask computed
+        self.roi_id = next(_roi_ids)    # identifies the ROI's trace; kept by copy() and translated()
+
+    def copy(self):
+        """
+        Deep copy of the ROI, with the same id.
+        """
+        return self.translated(0, 0)
 
     def translated(self, *args):
         """
-        Needed for full ROI movement - translated method returns a QPolygon
+        Needed for full ROI movement - translated method returns a QPolygon, make it an Roi
         """
-        poly = super().translated(*args)
+        poly = Roi(super().translated(*args))
+        poly.roi_id = self.roi_id
         poly.visible = self.visible
         poly.color = self.color
         poly.activated = self.activated
         return poly
 
+    def mask(self, shape):
+        """
+        Bounding-box mask of the ROI (see poly_window_mask), cached until the ROI's points change.
+        """
+        points = tuple((p.x(), p.y()) for p in self)
+        if self.mask_cache is None or self.mask_cache[:2] != (points, shape):
+            self.mask_cache = (points, shape) + poly_window_mask(self, shape)
+        return self.mask_cache[2:]
+
 
 class Arrow(QtCore.QLine):
     """
@@ -108,37 +129,78 @@ class Arrow(QtCore.QLine):
         self.head.clear()
 
 
-def poly2mask(qpoly, shape):
+def poly_window_mask(qpoly, shape):
     """
-    Convert polygon to binary mask
+    Rasterize a polygon within its bounding box.
 
-    ref: http://stackoverflow.com/questions/3654289/scipy-create-2d-polygon-mask
+    Scanline fill with the even-odd rule: for every row of pixel centres in the bounding box, each edge crossing the
+    row toggles inside/outside from the first pixel centre at or right of the crossing.  All rows and edges are done
+    at once with numpy.
 
     Parameters
     ----------
-    poly : QPolygon
+    qpoly : QPolygon
 
-    shape : (x, y)
-        extent
-    """
+    shape : (y, x)
+        extent; the mask is clipped to it
 
+    Returns
+    -------
+    window : (slice, slice)
+        the polygon's bounding box within the extent, so ``frame[window][mask]`` are the pixels inside
+    mask : ndarray (bool)
+        mask over the window
+    """
     ny, nx = shape
+    verts = np.array([(p.x(), p.y()) for p in qpoly], dtype=np.float64).reshape(-1, 2)
+    if len(verts) < 3:
+        return (slice(0, 0), slice(0, 0)), np.zeros((0, 0), bool)
+
+    x0 = int(max(0, np.floor(verts[:, 0].min())))
+    x1 = int(min(nx, np.floor(verts[:, 0].max()) + 1))
+    y0 = int(max(0, np.floor(verts[:, 1].min())))
+    y1 = int(min(ny, np.floor(verts[:, 1].max()) + 1))
+    window = (slice(y0, max(y0, y1)), slice(x0, max(x0, x1)))
+    if x1 <= x0 or y1 <= y0:
+        return window, np.zeros((max(0, y1 - y0), max(0, x1 - x0)), bool)
 
-    poly_verts = [(p.x(), p.y()) for p in qpoly]
+    xa, ya = verts[:, 0], verts[:, 1]
+    xb, yb = np.roll(xa, -1), np.roll(ya, -1)
+    rows = np.arange(y0, y1, dtype=np.float64)[:, None]
 
-    # Create vertex coordinates for each grid cell...
-    # (<0,0> is at the top left of the grid in this system)
-    x, y = np.meshgrid(np.arange(nx), np.arange(ny))
-    x, y = x.flatten(), y.flatten()
+    crosses = ((ya <= rows) & (rows < yb)) | ((yb <= rows) & (rows < ya))    # half-open, so vertices count once
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xc = xa + (rows - ya) * (xb - xa) / (yb - ya)
 
-    points = np.vstack((x, y)).T
+    r, e = np.nonzero(crosses)
+    col = np.clip(np.ceil(xc[r, e]).astype(np.intp) - x0, 0, x1 - x0)
+    toggles = np.zeros((y1 - y0, x1 - x0 + 1), np.intp)
+    np.add.at(toggles, (r, col), 1)
 
-    path = Path(poly_verts)
+    mask = (np.cumsum(toggles, axis=1)[:, :-1] & 1).astype(bool)
+    return window, mask
 
-    grid = path.contains_points(points)
-    grid = grid.reshape((ny, nx))
 
-    return grid
+def poly2mask(qpoly, shape):
+    """
+    Convert polygon to binary mask
+
+    Parameters
+    ----------
+    poly : QPolygon
+
+    shape : (y, x)
+        extent
+
+    Returns
+    -------
+    mask : ndarray (bool)
+        full-extent mask.  Use poly_window_mask (or Roi.mask) to work on the bounding box only.
+    """
+    window, wmask = poly_window_mask(qpoly, shape)
+    mask = np.zeros(shape, bool)
+    mask[window] = wmask
+    return mask
 
 
 class TimeLapseScreen(QtWidgets.QLabel):
@@ -211,7 +273,7 @@ class CapScreen(QtWidgets.QLabel):
         self._set_frame(CAP_SCREEN_STYLE_STILL0)
         gray = np.ndarray(self.cap_size, dtype=np.uint8)
         gray.fill(180)
-        im = QtGui.QImage(gray.data, gray.shape[1], gray.shape[0], QtGui.QImage.Format_Indexed8)
+        im = QtGui.QImage(gray.data, gray.shape[1], gray.shape[0], gray.strides[0], QtGui.QImage.Format_Indexed8)
         pix = QtGui.QPixmap.fromImage(im)
         self.setPixmap(pix)
 
@@ -289,9 +351,13 @@ class CapScreen(QtWidgets.QLabel):
                 print('filter: ', filter)
 
 
-class LiveScreen(QtWidgets.QLabel):
+class LiveOverlay(object):
     """
-    A class for managing the main screen.
+    ROIs, arrows, mouse handling and titling for the main screen, independent of how the image itself is drawn.
+    Mixed in ahead of the widget class by LiveScreen (QLabel) and glscreen.GLLiveScreen (QOpenGLWidget).  The widget
+    class must provide an ``image_rect()`` method returning the rectangle of the displayed image, (0, 0, width,
+    height) in image coordinates, and calls ``paint_overlay``.  (Not an abc.abstractmethod: ABCMeta doesn't mix with
+    the Qt widget metaclass.)
 
     ROI State:
             0 - nothing happening
@@ -301,7 +367,7 @@ class LiveScreen(QtWidgets.QLabel):
 
     """
 
-    def __init__(self, size, *args, **kwargs):
+    def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.roi_button = None
@@ -324,23 +390,6 @@ class LiveScreen(QtWidgets.QLabel):
         self.live_title = ''
         self.live_title_color = LIVE_TITLE_COLOR_LIVE
 
-        self.setObjectName(LIVE_SCREEN_TAG)
-        self._set_frame(LIVE_SCREEN_STYLE_LIVE)
-
-        gray = np.ndarray(size, dtype=np.uint8)
-        gray.fill(100)
-        im = QtGui.QImage(gray.data, gray.shape[1], gray.shape[0], QtGui.QImage.Format_Indexed8)
-        pix = QtGui.QPixmap.fromImage(im)
-        self.setPixmap(pix)
-
-    def _set_frame(self, style):
-        """
-        Helper function for quick frame changes
-        """
-
-        tag = self.objectName()
-        self.setStyleSheet('#' + tag + style)
-
     def connect_roi_button(self, roi_button):
         """
         Method to associate the ROI button on the viewer in order to maintain its enable state.
@@ -381,12 +430,15 @@ class LiveScreen(QtWidgets.QLabel):
         Return the mask corresponding to the active roi.  If only one ROI
         is defined, treat is as if it were active.  If no ROIs or if more than
         one and nothing active, return None.
+
+        The mask is returned as (window, mask) (see Roi.mask): ``frame[window][mask]`` are the ROI's pixels.
         """
+        shape = (self.image_rect().height(), self.image_rect().width())
         if len(self.roi_list) == 1:
-            return poly2mask(self.roi_list[0], (self.pixmap().height(), self.pixmap().width()))
+            return self.roi_list[0].mask(shape)
         for r in self.roi_list:
             if r.activated:
-                return poly2mask(r, (self.pixmap().height(), self.pixmap().width()))
+                return r.mask(shape)
 
         return None
 
@@ -443,7 +495,7 @@ class LiveScreen(QtWidgets.QLabel):
             position within the pixmap
 
         """
-        return pos - (self.rect().center() - self.pixmap().rect().center())
+        return pos - (self.rect().center() - self.image_rect().center())
 
     def pos_in_widget(self, pos):
         """
@@ -460,7 +512,7 @@ class LiveScreen(QtWidgets.QLabel):
 
         """
 
-        return pos + (self.rect().center() - self.pixmap().rect().center())
+        return pos + (self.rect().center() - self.image_rect().center())
 
     def mouseMoveEvent(self, event):
         """
@@ -482,7 +534,7 @@ class LiveScreen(QtWidgets.QLabel):
         """
 
         ppos = self.pos_in_pixmap(event.pos())
-        if not self.pixmap().rect().contains(ppos):
+        if not self.image_rect().contains(ppos):
             return
 
         self.last_mouse_pos = ppos
@@ -546,7 +598,7 @@ class LiveScreen(QtWidgets.QLabel):
             return
 
         ppos = self.pos_in_pixmap(event.pos())
-        if not self.pixmap().rect().contains(ppos):     # Have to be inside the pixmap.
+        if not self.image_rect().contains(ppos):     # Have to be inside the pixmap.
             return
 
         self.last_press_pos = ppos
@@ -571,7 +623,7 @@ class LiveScreen(QtWidgets.QLabel):
 
                 if r.containsPoint(ppos, Qt.OddEvenFill):  # on the ROI?
                     self.roi_state = 2
-                    self.roi_move_coords = [ri, -1, ppos, Roi(r)]  # move entire ROI
+                    self.roi_move_coords = [ri, -1, ppos, r.copy()]  # move entire ROI
                     r.activated = True
                     self.update()
                     return
@@ -600,7 +652,7 @@ class LiveScreen(QtWidgets.QLabel):
             return
 
         ppos = self.pos_in_pixmap(event.pos())
-        if not self.pixmap().rect().contains(ppos):
+        if not self.image_rect().contains(ppos):
             return
 
         if self.roi_state == 3:  # draggin for arrow building.
@@ -637,7 +689,7 @@ class LiveScreen(QtWidgets.QLabel):
             return
 
         ppos = self.pos_in_pixmap(event.pos())
-        if not self.pixmap().rect().contains(ppos):
+        if not self.image_rect().contains(ppos):
             return
 
         if self.roi_state == 0:  # quiescent state, start building the ROI.
@@ -654,32 +706,28 @@ class LiveScreen(QtWidgets.QLabel):
 
         self.update()
 
-    def paintEvent(self, event):
+    def paint_overlay(self, painter):
         """
-        Locally modified paint event to add in the graphics drawing and titling.
+        Draw the graphics and titling over the image.
 
         Parameters
         ----------
-        event
+        painter : QPainter
+            active on this widget
 
         Returns
         -------
 
         """
 
-        super().paintEvent(event)
-
-        painter = QtGui.QPainter()
-        painter.begin(self)
-
         # drawing offsets:
-        do_x = self.rect().center().x() - self.pixmap().rect().center().x()
-        do_y = self.rect().center().y() - self.pixmap().rect().center().y()
+        do_x = self.rect().center().x() - self.image_rect().center().x()
+        do_y = self.rect().center().y() - self.image_rect().center().y()
 
         painter.setPen(MOUSE_POS_COLOR)
         painter.setFont(QtGui.QFont(MOUSE_POS_FONT, MOUSE_POS_FONTSIZE))
         s = '(%4.4d,%4.4d)' % (self.last_mouse_pos.x(), self.last_mouse_pos.y())
-        painter.drawText(MOUSE_POS_X + do_x, MOUSE_POS_Y + do_y, s)
+        painter.drawText(self.image_rect().width() - MOUSE_POS_X + do_x, MOUSE_POS_Y + do_y, s)
 
         painter.setPen(self.live_title_color)
         painter.setFont(QtGui.QFont(LIVE_TITLE_FONT, LIVE_TITLE_FONTSIZE))
@@ -723,4 +771,51 @@ class LiveScreen(QtWidgets.QLabel):
         if self.roi_state == 3:
             painter.drawLine(self.arrow_build.translated(do_x, do_y))
 
+
+class LiveScreen(LiveOverlay, QtWidgets.QLabel):
+    """
+    A class for managing the main screen.  The image is shown as a pixmap, set with setPixmap.
+    """
+
+    def __init__(self, size, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.setObjectName(LIVE_SCREEN_TAG)
+        self._set_frame(LIVE_SCREEN_STYLE_LIVE)
+
+        gray = np.ndarray(size, dtype=np.uint8)
+        gray.fill(100)
+        im = QtGui.QImage(gray.data, gray.shape[1], gray.shape[0], gray.strides[0], QtGui.QImage.Format_Indexed8)
+        pix = QtGui.QPixmap.fromImage(im)
+        self.setPixmap(pix)
+
+    def _set_frame(self, style):
+        """
+        Helper function for quick frame changes
+        """
+
+        tag = self.objectName()
+        self.setStyleSheet('#' + tag + style)
+
+    def image_rect(self):
+        return self.pixmap().rect()
+
+    def paintEvent(self, event):
+        """
+        Locally modified paint event to add in the graphics drawing and titling.
+
+        Parameters
+        ----------
+        event
+
+        Returns
+        -------
+
+        """
+
+        super().paintEvent(event)
+
+        painter = QtGui.QPainter()
+        painter.begin(self)
+        self.paint_overlay(painter)
         painter.end()
@@ -0,0 +1,142 @@
+"""
+Synthetic microscope scene for the Pseudo camera.
+
+The scene (bright-field cells, a patch pipette, vignetting) is computed once, in ADU per ms of exposure, on a canvas
+a little larger than the frame so slow stage drift is just a shifted view of it.  It's scaled so that even the longest
+exposure (4000 ms) stays below full scale at 10 bits; the short exposures are correspondingly dim.  Each frame adds
+shot and read noise from a pool of seeded float32 standard-normal images (also viewed at random row offsets, so the
+pool doesn't visibly repeat), a dark offset and hot pixels, all in preallocated buffers.  Frames are deterministic for
+a given seed and sequence number, and cheap enough for a few hundred frames a second, so the whole pipeline can be
+load-tested without a camera.
+"""
+import numpy as np
+
+SCENE_RATE = 0.2            # ADU per ms of exposure at the brightest point of the scene
+SCENE_CELLS = 12
+SCENE_VIGNETTING = 0.35     # fractional fall-off in the corners
+ADU_PER_ELECTRON = 0.25     # shot noise: variance in ADU^2 is the signal in ADU times this
+READ_NOISE = 2.             # ADU rms
+DARK_OFFSET = 10.           # ADU
+HOT_PIXEL_FRACTION = 5e-4
+HOT_PIXEL_RATE = (0.5, 5.)  # dark current range of hot pixels, ADU per ms
+
+NOISE_POOL = 8              # standard-normal images in the pool
+DRIFT_MARGIN = 16           # canvas margin, the most drift in pixels
+DRIFT_PERIOD_S = 300.       # stage drift period
+FLICKER_PERIOD_S = 60.      # illumination drift period
+FLICKER_DEPTH = 0.05
+
+
+class SyntheticScene(object):
+    """
+    Generator of synthetic frames.
+    """
+
+    def __init__(self, shape, pixel_bits, seed=0):
+        """
+
+        Parameters
+        ----------
+        shape : (int, int)
+            frame shape (rows, columns)
+        pixel_bits : int
+            frames are clipped to 0 .. 2**pixel_bits - 1
+        seed : int
+            seeds the scene, the noise pool and the per-frame noise choices
+        """
+        self.shape = shape
+        self.maxval = 2**pixel_bits - 1
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+
+        h, w = shape
+        m = DRIFT_MARGIN
+        self.scene = self._make_scene((h + 2 * m, w + 2 * m), rng)
+        self.noise = rng.standard_normal((NOISE_POOL, h + 2 * m, w), dtype=np.float32)
+
+        n_hot = int(HOT_PIXEL_FRACTION * h * w)
+        self.hot_index = rng.choice(h * w, n_hot, replace=False)
+        self.hot_rate = rng.uniform(HOT_PIXEL_RATE[0], HOT_PIXEL_RATE[1], n_hot).astype(np.float32)
+
+        self.signal = np.empty(shape, np.float32)
+        self.sigma = np.empty(shape, np.float32)
+
+    @staticmethod
+    def _make_scene(shape, rng):
+        """
+        Transmission of the field (cells, pipette) times vignetting, scaled to ADU per ms at its brightest.
+        """
+        h, w = shape
+        scene = np.ones(shape, np.float32)
+        y, x = np.ogrid[0:h, 0:w]
+
+        """
+        Cells: ellipses, a little darker than the background, with a bright rim and a darker nucleus.
+        """
+        for i in range(SCENE_CELLS):
+            cy, cx = rng.uniform(0.1, 0.9) * h, rng.uniform(0.1, 0.7) * w
+            ry, rx = rng.uniform(25., 70., 2)
+            y0, y1 = int(max(cy - ry - 4, 0)), int(min(cy + ry + 5, h))
+            x0, x1 = int(max(cx - rx - 4, 0)), int(min(cx + rx + 5, w))
+            r = np.sqrt(((y[y0:y1] - cy) / ry) ** 2 + ((x[:, x0:x1] - cx) / rx) ** 2)
+            cell = scene[y0:y1, x0:x1]
+            cell[r < 1.] *= 0.85
+            cell[(r >= 0.92) & (r < 1.05)] *= 1.25
+            cell[r < 0.3] *= 0.8
+
+        """
+        Pipette: a tapering tube entering from the right, tip near the centre, with dark walls.
+        """
+        tip_x, yc = 0.55 * w, 0.5 * h
+        half = 3. + 0.12 * np.maximum(x - tip_x, 0.)
+        d = np.abs(y - yc)
+        inside = (x >= tip_x) & (d < half)
+        scene[inside & (d >= half - 4.)] *= 0.3
+        scene[inside & (d < half - 4.)] *= 0.9
+
+        r2 = ((y - h / 2.) / (h / 2.)) ** 2 / 2. + ((x - w / 2.) / (w / 2.)) ** 2 / 2.
+        scene *= (1. - SCENE_VIGNETTING * r2).astype(np.float32)
+        scene *= SCENE_RATE / scene.max()
+        return scene
+
+    def frame(self, out, exposure_ms, seq, t_s, dark=False):
+        """
+        Generate a frame.
+
+        Parameters
+        ----------
+        out : ndarray
+            integer frame of ``shape`` to fill
+        exposure_ms : float
+        seq : int
+            frame sequence number, picks the noise
+        t_s : float
+            scene time in seconds, sets the drift
+        dark : bool
+            no illumination (dark offset, hot pixels and noise only), e.g. for calibrations
+        """
+        h, w = self.shape
+        m = DRIFT_MARGIN
+        rng = np.random.default_rng((self.seed, seq))
+        k, offset = rng.integers(NOISE_POOL), rng.integers(2 * m + 1)
+        noise = self.noise[k, offset:offset + h]
+
+        signal, sigma = self.signal, self.sigma
+        if dark:
+            signal.fill(0.)
+        else:
+            phase = 2. * np.pi * t_s
+            dy = int(round((m - 1) * np.sin(phase / DRIFT_PERIOD_S)))
+            dx = int(round((m - 1) * np.sin(phase / DRIFT_PERIOD_S / 2.)))
+            level = exposure_ms * (1. + FLICKER_DEPTH * np.sin(phase / FLICKER_PERIOD_S))
+            np.multiply(self.scene[m + dy:m + dy + h, m + dx:m + dx + w], level, out=signal)
+        signal.flat[self.hot_index] += self.hot_rate * exposure_ms
+
+        np.multiply(signal, ADU_PER_ELECTRON, out=sigma)
+        sigma += READ_NOISE ** 2
+        np.sqrt(sigma, out=sigma)
+        sigma *= noise
+        signal += sigma
+        signal += DARK_OFFSET
+        np.clip(signal, 0., self.maxval, out=signal)
+        np.copyto(out, signal, casting='unsafe')
@@ -0,0 +1,74 @@
+"""
+Tests of the Pseudo camera's synthetic scene (numpy only, no Qt or camera needed).
+
+Run from the top directory with ``python -m pytest tests`` or ``python -m unittest discover tests``.
+"""
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import DARK_OFFSET, SyntheticScene
+
+SHAPE = (512, 640)
+PIXEL_BITS = 10
+EXPOSURES = (20, 28, 40, 57, 80, 100, 140, 200, 280, 400, 570, 800, 1000, 1400, 2000, 2800, 4000)  # Camera table
+FLICKER_PEAK_S = 15.        # scene time of the brightest illumination
+
+
+class SyntheticSceneTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scene = SyntheticScene(SHAPE, PIXEL_BITS, seed=3)
+        cls.not_hot = np.ones(SHAPE, bool)
+        cls.not_hot.flat[cls.scene.hot_index] = False
+
+    def frame(self, scene, exposure_ms, seq, t_s=0., dark=False):
+        out = np.empty(SHAPE, np.int16)
+        scene.frame(out, exposure_ms, seq, t_s, dark)
+        return out
+
+    def test_deterministic(self):
+        """
+        The same seed and sequence number give the same frame, other sequence numbers or seeds don't.
+        """
+        a = self.frame(self.scene, 100, 7)
+        self.frame(self.scene, 100, 8)
+        np.testing.assert_array_equal(a, self.frame(self.scene, 100, 7))
+        np.testing.assert_array_equal(a, self.frame(SyntheticScene(SHAPE, PIXEL_BITS, seed=3), 100, 7))
+        self.assertFalse(np.array_equal(a, self.frame(self.scene, 100, 8)))
+        self.assertFalse(np.array_equal(a, self.frame(SyntheticScene(SHAPE, PIXEL_BITS, seed=4), 100, 7)))
+
+    def test_dark(self):
+        """
+        Dark frames hold only the offset, noise and hot pixels, whatever the exposure.
+        """
+        for exposure_ms in (EXPOSURES[0], EXPOSURES[-1]):
+            dark = self.frame(self.scene, exposure_ms, 1, FLICKER_PEAK_S, dark=True)[self.not_hot]
+            self.assertAlmostEqual(np.median(dark), DARK_OFFSET, delta=1.)
+            self.assertLess(dark.max(), 2 * DARK_OFFSET + 10)
+
+        hot = self.frame(self.scene, 1000, 1, dark=True).flat[self.scene.hot_index]
+        self.assertGreater(np.median(hot), 2 * DARK_OFFSET)
+
+    def test_no_clipping(self):
+        """
+        Apart from hot pixels, no exposure in the table reaches full scale, even at the brightest illumination, and
+        each is brighter than the last.
+        """
+        maxval = 2**PIXEL_BITS - 1
+        prior = DARK_OFFSET
+        for exposure_ms in EXPOSURES:
+            f = self.frame(self.scene, exposure_ms, 2, FLICKER_PEAK_S)[self.not_hot]
+            self.assertLess(f.max(), maxval, '%d ms exposure clipped' % exposure_ms)
+            self.assertGreater(f.min(), 0, '%d ms exposure clipped' % exposure_ms)
+            self.assertGreater(np.median(f), prior)
+            prior = np.median(f)
+
+
+if __name__ == '__main__':
+    unittest.main()
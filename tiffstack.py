@@ -0,0 +1,218 @@
+"""
+Direct multi-page TIFF / BigTIFF writer for image stacks.
+
+Pages are written strictly sequentially: each page is a block of [IFD][out-of-line tag values][image strip].  Since
+the next page always starts where this block ends, the next-IFD offset is filled in when the IFD is written and never
+revisited; only the last page's next-IFD offset is zeroed when the file is closed.  Pixel data goes from the numpy
+buffer to the file without an intermediate PIL image, so throughput is close to raw disk bandwidth.
+
+Custom tags (e.g. from doriclib.DoricImageFileDirectory) are taken from any tag -> value mapping.  If the mapping has
+a PIL-style ``tagtype`` dictionary the tag types are taken from it, otherwise they are inferred from the values.
+"""
+import struct
+from fractions import Fraction
+
+import numpy as np
+
+TIFF_BYTE = 1
+TIFF_ASCII = 2
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_RATIONAL = 5
+TIFF_SBYTE = 6
+TIFF_UNDEFINED = 7
+TIFF_SSHORT = 8
+TIFF_SLONG = 9
+TIFF_SRATIONAL = 10
+TIFF_FLOAT = 11
+TIFF_DOUBLE = 12
+TIFF_LONG8 = 16
+
+_TYPE_DTYPE = {TIFF_BYTE: '<u1', TIFF_ASCII: '<u1', TIFF_SHORT: '<u2', TIFF_LONG: '<u4', TIFF_RATIONAL: '<u4',
+               TIFF_SBYTE: '<i1', TIFF_UNDEFINED: '<u1', TIFF_SSHORT: '<i2', TIFF_SLONG: '<i4',
+               TIFF_SRATIONAL: '<i4', TIFF_FLOAT: '<f4', TIFF_DOUBLE: '<f8', TIFF_LONG8: '<u8'}
+
+# Baseline tags written by the writer itself; the same tags in a custom mapping are ignored.
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_SAMPLE_FORMAT = 339
+
+CLASSIC_LIMIT = 2**32 - 1
+
+
+def _encode(ttype, value):
+    """
+    Encode a tag value as little-endian bytes.
+
+    Returns
+    -------
+    data : bytes
+    count : int
+        TIFF value count
+    """
+    if ttype == TIFF_ASCII:
+        data = value.encode('ascii', 'replace') if isinstance(value, str) else bytes(value)
+        data += b'\0'
+        return data, len(data)
+
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value), len(value)
+
+    values = value if isinstance(value, (tuple, list, np.ndarray)) else (value,)
+    if ttype in (TIFF_RATIONAL, TIFF_SRATIONAL):
+        flat = []
+        for v in values:
+            if not hasattr(v, 'numerator'):
+                v = Fraction(v).limit_denominator(2**31 - 1)
+            flat += [int(v.numerator), int(v.denominator)]
+        return np.array(flat, dtype=_TYPE_DTYPE[ttype]).tobytes(), len(values)
+
+    return np.array(values, dtype=_TYPE_DTYPE[ttype]).tobytes(), len(values)
+
+
+def _infer_type(value):
+    v = value[0] if isinstance(value, (tuple, list)) and len(value) > 0 else value
+    if isinstance(value, str):
+        return TIFF_ASCII
+    if isinstance(value, (bytes, bytearray)):
+        return TIFF_UNDEFINED
+    if isinstance(v, float):
+        return TIFF_DOUBLE
+    if hasattr(v, 'numerator') and not isinstance(v, int):
+        return TIFF_RATIONAL
+    return TIFF_LONG
+
+
+class StackWriter(object):
+    """
+    Writes 2-D uint16 frames as the pages of a TIFF (or BigTIFF) file.
+    """
+
+    def __init__(self, fn, bigtiff=False):
+        """
+
+        Parameters
+        ----------
+        fn : str
+            file path
+        bigtiff : bool
+            write BigTIFF (64-bit offsets) so the file may exceed 4 GB.  A classic TIFF raises ValueError on the page
+            that would take it past 4 GB.
+        """
+        self.bigtiff = bigtiff
+        self.pages = 0
+        self.f = open(fn, 'wb', buffering=2**20)
+
+        if bigtiff:
+            self.f.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 16))
+            self.next_pos = 8       # where the offset of the next IFD goes
+            self.pos = 16
+            self.offset_type = TIFF_LONG8
+            self.inline_size = 8
+        else:
+            self.f.write(b'II' + struct.pack('<HI', 42, 8))
+            self.next_pos = 4
+            self.pos = 8
+            self.offset_type = TIFF_LONG
+            self.inline_size = 4
+
+    def write(self, image, tags=None):
+        """
+        Append a page.
+
+        Parameters
+        ----------
+        image : ndarray
+            2-D frame, written as uint16 (converted only if it isn't already contiguous little-endian uint16)
+        tags : mapping
+            extra tags for this page, tag -> value, optionally with a PIL-style ``tagtype`` dict.
+        """
+        image = np.ascontiguousarray(image, dtype='<u2')
+        h, w = image.shape
+
+        entries = {TAG_IMAGE_WIDTH: (TIFF_LONG, w),
+                   TAG_IMAGE_LENGTH: (TIFF_LONG, h),
+                   TAG_BITS_PER_SAMPLE: (TIFF_SHORT, 16),
+                   TAG_COMPRESSION: (TIFF_SHORT, 1),
+                   TAG_PHOTOMETRIC: (TIFF_SHORT, 1),      # black is zero
+                   TAG_STRIP_OFFSETS: (self.offset_type, 0),  # filled in below
+                   TAG_SAMPLES_PER_PIXEL: (TIFF_SHORT, 1),
+                   TAG_ROWS_PER_STRIP: (TIFF_LONG, h),
+                   TAG_STRIP_BYTE_COUNTS: (self.offset_type, image.nbytes),
+                   TAG_SAMPLE_FORMAT: (TIFF_SHORT, 1)}
+
+        if tags is not None:
+            tagtype = getattr(tags, 'tagtype', {})
+            for tag, value in tags.items():
+                if tag not in entries:
+                    entries[tag] = (tagtype.get(tag) or _infer_type(value), value)
+
+        encoded = [(tag, ttype) + _encode(ttype, value) for tag, (ttype, value) in sorted(entries.items())]
+
+        """
+        Lay out the block: IFD, then the values that don't fit in an entry, then the strip.
+        """
+        if self.bigtiff:
+            ifd_size = 8 + 20 * len(encoded) + 8
+        else:
+            ifd_size = 2 + 12 * len(encoded) + 4
+        ifd_offset = self.pos
+        extra_offset = ifd_offset + ifd_size
+        extra = bytearray()
+        layout = []
+        for tag, ttype, data, count in encoded:
+            if len(data) > self.inline_size:
+                layout.append((tag, ttype, count, None, extra_offset + len(extra)))
+                extra += data
+                if len(extra) % 2:
+                    extra += b'\0'      # values start on word boundaries
+            else:
+                layout.append((tag, ttype, count, data, None))
+
+        strip_offset = extra_offset + len(extra)
+        strip_offset += (-strip_offset) % 16
+        block_end = strip_offset + image.nbytes
+
+        if not self.bigtiff and block_end > CLASSIC_LIMIT:
+            raise ValueError('Stack exceeds 4 GB, BigTIFF required')
+
+        if self.bigtiff:
+            ifd = bytearray(struct.pack('<Q', len(layout)))
+            for tag, ttype, count, data, offset in layout:
+                if tag == TAG_STRIP_OFFSETS:
+                    data = struct.pack('<Q', strip_offset)
+                value = data.ljust(8, b'\0') if data is not None else struct.pack('<Q', offset)
+                ifd += struct.pack('<HHQ', tag, ttype, count) + value
+            ifd += struct.pack('<Q', block_end)
+        else:
+            ifd = bytearray(struct.pack('<H', len(layout)))
+            for tag, ttype, count, data, offset in layout:
+                if tag == TAG_STRIP_OFFSETS:
+                    data = struct.pack('<I', strip_offset)
+                value = data.ljust(4, b'\0') if data is not None else struct.pack('<I', offset)
+                ifd += struct.pack('<HHI', tag, ttype, count) + value
+            ifd += struct.pack('<I', block_end)
+
+        self.f.write(ifd)
+        self.f.write(extra)
+        self.f.write(b'\0' * (strip_offset - extra_offset - len(extra)))
+        self.f.write(memoryview(image).cast('B'))
+
+        self.next_pos = ifd_offset + ifd_size - (8 if self.bigtiff else 4)
+        self.pos = block_end
+        self.pages += 1
+
+    def close(self):
+        """
+        Terminate the IFD chain at the last page and close the file.
+        """
+        self.f.seek(self.next_pos)
+        self.f.write(b'\0' * (8 if self.bigtiff else 4))
+        self.f.close()